@@ -0,0 +1,7 @@
+# Settings for collect_static in the fabfile: the app settings with the
+# static files collected, fingerprinted, into the nginx root
+from APPNAME.conf.prod.settings import *
+
+STATIC_ROOT = 'STATICROOT'
+STATIC_URL = 'STATICURL'
+STATICFILES_STORAGE = 'STATICSTORAGE'
@@ -1,4 +1,6 @@
 import os
+import atexit
+import hashlib
 from fabric.api import *
 from fabric.contrib.console import confirm
 
@@ -20,6 +22,12 @@ deploy_host    =  deploy_username + '@'+server_hostname
 # pseudo inline-function for bash
 get_cur_timestamp = '$(date +%Y-%m-%d_%H%M%S)'
 
+# master connections opened by sshagent_connect(); settings.py files made
+# from older samples have no control socket settings
+sshagent_masters = []
+ssh_control_dir     = globals().get('ssh_control_dir', os.path.expanduser('~/.ssh/django-server-fabfile'))
+ssh_control_persist = globals().get('ssh_control_persist', '10m')
+
 
 
 # MAIN TASKS
@@ -1142,13 +1150,49 @@ def sshagent_run(cmd):
     Runs a command with SSH agent forwarding enabled.
     
     Note:: Fabric (and paramiko) can't forward your SSH agent. 
-    This helper uses your system's ssh to do so.
+    This helper uses your system's ssh to do so, over one shared
+    ControlMaster connection per host, see sshagent_connect().
     """
 
     for h in env.hosts:
-        try:
-            # catch the port number to pass to ssh
-            host, port = h.split(':')
-            local('ssh -p %s -A %s "%s"' % (port, host, cmd))
-        except ValueError:
-            local('ssh -A %s "%s"' % (h, cmd))
+        local('ssh %s "%s"' % (sshagent_connect(h), cmd))
+
+def sshagent_connect(h):
+    """
+    Helper function.
+    Returns the ssh arguments for reusing the master connection to ``h``
+
+    The master is health checked with ``ssh -O check`` the first time a host
+    is used and (re)started if it isn't answering. All masters are shut down
+    with ``ssh -O exit`` when fab exits.
+    """
+    try:
+        # catch the port number to pass to ssh
+        host, port = h.split(':')
+        args = '-p %s ' % port
+    except ValueError:
+        host, args = h, ''
+    # a short hash keeps the socket path under the unix limit for long names
+    control_name = hashlib.md5('%s@%s' % (env.user, h)).hexdigest()[:12]
+    args += '-A -o ControlPath=%s/%s ' % (ssh_control_dir, control_name)
+    args += '-o ControlMaster=auto -o ControlPersist=%s %s' % (ssh_control_persist, host)
+
+    if args not in sshagent_masters:
+        if not os.path.isdir(ssh_control_dir):
+            os.makedirs(ssh_control_dir, 0700)
+        with settings(hide('running', 'warnings', 'stdout', 'stderr'), warn_only=True):
+            if local('ssh -O check %s' % args).failed:
+                local('ssh -f -N %s' % args)
+        if not sshagent_masters:
+            atexit.register(sshagent_disconnect_all)
+        sshagent_masters.append(args)
+    return args
+
+def sshagent_disconnect_all():
+    """
+    Helper function.
+    Closes every master connection opened by sshagent_connect()
+    """
+    with settings(hide('running', 'warnings', 'stdout', 'stderr'), warn_only=True):
+        while sshagent_masters:
+            local('ssh -O exit %s' % sshagent_masters.pop())
@@ -1,7 +1,24 @@
 import os
+import StringIO
+import atexit
+import contextlib
+import difflib
+import functools
+import glob
+import hashlib
+import json
+import multiprocessing
+import re
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
 from fabric.api import *
 from fabric.contrib.console import confirm
+from fabric import job_queue
 from fabric.operations import _prefix_commands, _prefix_env_vars
+from fabric.state import connections
 
 """
 Base configuration
@@ -17,9 +34,117 @@ env.deploy_password  = 'password'
 env.team_users       = [ 'user1', 'user2' ]
 env.team_password    = 'password'
 
+env.database_password = 'password' # for the project_name database user
+env.database_host     = '127.0.0.1'
+env.database_port     = 5432
+
+# put PgBouncer between the Django apps and PostgreSQL, see setup_pgbouncer();
+# the app config needs the DATABASEHOST and DATABASEPORT placeholders for it
+env.pgbouncer             = False
+env.pgbouncer_port        = 6432
+env.pgbouncer_pool_mode   = 'session'
+env.pgbouncer_pool_size   = 20
+env.pgbouncer_max_clients = 1000
+
+# tune_postgresql() sizes memory for this many connections
+env.pg_max_connections = 100
+
+# mod_wsgi daemon sizing, see wsgi_daemon_sizing(): the RSS of one daemon
+# process when none is running to measure, the share of RAM all the
+# daemons may use, concurrent requests per core, and the longest a
+# request may take
+env.wsgi_worker_rss_mb      = 100
+env.wsgi_memory_share       = 0.5
+env.wsgi_requests_per_core  = 4
+env.wsgi_request_timeout    = 60
+
+# what runs Django behind nginx: 'apache' (mod_wsgi on port 9000), or
+# 'gunicorn' / 'uwsgi' installed in each virtualenv, run by supervisor and
+# proxied to over a unix socket. app_server_worker is the gunicorn worker
+# class, e.g. 'gevent' for async workers.
+env.app_server        = 'apache'
+env.app_server_worker = 'sync'
+env.app_server_commands = {
+    'gunicorn': '%(env_path)s/current/bin/gunicorn --pythonpath %(env_path)s/apache --bind unix:%(socket)s'
+                ' --workers %(processes)s --threads %(threads)s --worker-class %(worker)s'
+                ' --timeout %(timeout)s --max-requests 10000 wsgi_app:application',
+    'uwsgi':    '%(env_path)s/current/bin/uwsgi --master --die-on-term --http-socket %(socket)s'
+                ' --chmod-socket=660 --wsgi-file %(env_path)s/apache/wsgi_app.py'
+                ' --processes %(processes)s --threads %(threads)s --harakiri %(timeout)s'
+                ' --max-requests 10000 --vacuum',
+}
+
+# nginx micro-caching of anonymous Django responses: how long responses are
+# kept, longer or shorter times per URL prefix (e.g. {'/surveys/': '30s'}),
+# and the cookies that always bypass the cache. Staging is cached apart, in
+# microcache_dir-staging
+env.nginx_microcache         = False
+env.microcache_ttl           = '1s'
+env.microcache_locations     = {}
+env.microcache_dir           = '/var/cache/nginx/django'
+env.microcache_size          = '1g'
+env.microcache_bypass_cookies = ['sessionid', 'csrftoken']
+
+# static files, see collect_static(): the URL they are served under, the
+# storage that fingerprints their names, the extensions that get .gz and
+# .br siblings, and whether nginx has the brotli module to serve the .br
+env.static_url      = '/static/'
+env.static_storage  = 'django.contrib.staticfiles.storage.CachedStaticFilesStorage'
+env.static_compress = ['css', 'js', 'svg', 'json', 'xml', 'txt', 'html', 'map', 'ico', 'eot', 'ttf']
+env.static_brotli   = False
+
+# nginx performance profile, one of env.nginx_profiles, with single values
+# overridden from env.nginx_settings, see nginx_profile()
+env.nginx_profile  = 'default'
+env.nginx_settings = {}
+env.nginx_profiles = {
+    'default': {
+        'worker_processes':        'auto',
+        'worker_connections':      1024,
+        'multi_accept':            'off',
+        'upstream_keepalive':      16,
+        'proxy_connect_timeout':   '5s',
+        'proxy_send_timeout':      '60s',
+        'proxy_read_timeout':      '60s',
+        'proxy_buffer_size':       '8k',
+        'proxy_buffers':           '8 8k',
+        'proxy_busy_buffers_size': '16k',
+        'client_max_body_size':    '10m',
+    },
+    'high_traffic': {
+        'worker_processes':        'auto',
+        'worker_connections':      4096,
+        'multi_accept':            'on',
+        'upstream_keepalive':      64,
+        'proxy_connect_timeout':   '3s',
+        'proxy_send_timeout':      '30s',
+        'proxy_read_timeout':      '30s',
+        'proxy_buffer_size':       '16k',
+        'proxy_buffers':           '16 16k',
+        'proxy_busy_buffers_size': '32k',
+        'client_max_body_size':    '10m',
+    },
+    'low_memory': {
+        'worker_processes':        1,
+        'worker_connections':      512,
+        'multi_accept':            'off',
+        'upstream_keepalive':      4,
+        'proxy_connect_timeout':   '5s',
+        'proxy_send_timeout':      '60s',
+        'proxy_read_timeout':      '60s',
+        'proxy_buffer_size':       '4k',
+        'proxy_buffers':           '4 4k',
+        'proxy_busy_buffers_size': '8k',
+        'client_max_body_size':    '10m',
+    },
+}
+
 env.appname = 'surveytool'
 env.virtual_environments = ['research.liveingreatness.com']
 env.git_repo = 'git://github.com/adamfeuer/surveytool.git'
+# uploaded as <appname>.config into each virtual environment, with the
+# DATABASEHOST and DATABASEPORT placeholders in its database settings
+# replaced by PgBouncer or database_host and database_port
 env.local_config_file_path = '~/.virtualenvs/surveytool/surveytool.config'
 
 env.ssl_organization_name = "Team Team Research"
@@ -27,6 +152,35 @@ env.ssl_contact = "postmaster@liveingreatness.com"
 
 env.single_user_mode = False
 
+env.python = 'python2.7'
+# how many old releases deploy() keeps around for rollback()
+env.keep_releases = 5
+
+# rolling_deploy(): the nginx host balancing env.hosts (None to skip the
+# drain), how many hosts go at once, and the share of hosts that must stay
+# in the pool for the whole rollout. Drained hosts are marked down in the
+# upstream file on the balancer, see lb_drained_hosts()
+env.load_balancer        = None
+env.lb_upstream_name     = 'django_cluster'
+env.lb_upstream_path     = '/etc/nginx/conf.d/django_cluster.conf'
+env.lb_backend_port      = 80
+env.rolling_batch_size   = 1
+env.rolling_min_capacity = 0.5
+env.health_check_path    = '/'
+env.health_check_retries = 10
+env.health_check_delay   = 3
+
+# data loading: parallel pg_restore jobs for custom-format dumps (0 is one
+# per core), where the seed dumps live (None for the repository checkout)
+# and whether the database tasks run against a local PostgreSQL instead,
+# see local_database(); swap_database() waits this many seconds for the
+# sessions on the project database to go away
+env.pg_restore_jobs      = 0
+env.psql_data_dir        = None
+env.db_local             = False
+env.local_psql_data_dir  = os.path.abspath('./data/psql')
+env.swap_session_timeout = 30
+
 env.team_groupname   = 'webdevelopers'
 env.deploy_username  = 'deploy'
 
@@ -38,6 +192,7 @@ env.team_sudo_cmds = [
     "/usr/sbin/service nginx start",
     "/usr/sbin/service nginx stop",
     "/usr/sbin/service nginx restart",
+    "/usr/sbin/service nginx reload",
     "/usr/sbin/service apache2 restart",
     "/usr/sbin/service apache2 reload",
     "/usr/sbin/service apache2 start",
@@ -47,9 +202,66 @@ env.team_sudo_cmds = [
 env.local_backup_dir  = os.path.abspath('./.bak')
 env.local_tar_dir     = os.path.abspath('./.tarballs')
 env.local_config_dir  = os.path.abspath('./conf')
+# templates from conf/ rendered by render_template(), named by content md5;
+# git ignores it since rendered configs hold passwords
+env.local_render_dir  = os.path.abspath('./.rendered')
+# .deb files in here are pushed to the apt cache of each host before
+# installing, fill it from a bootstrapped host with fetch_apt_cache
+env.local_apt_cache_dir = os.path.abspath('./.apt-cache')
+# wheels built from requirements.pip, one directory per md5 of the file;
+# build them somewhere matching the servers (distro, python, arch)
+env.local_wheelhouse_dir = os.path.abspath('./.wheelhouse')
+env.wheel_build_command  = 'pip wheel --wheel-dir %(wheelhouse)s -r %(requirements)s'
+
+# sockets for the shared ssh -A connection used by sshagent_run, the
+# connections checked by this process and the masters it started itself
+env.ssh_control_dir     = os.path.expanduser('~/.ssh/django-server-fabfile')
+env.ssh_control_persist = '10m'
+env.sshagent_checked    = []
+env.sshagent_masters    = []
+
+# remote state collected by gather_facts(), keyed by host string
+env.facts = {}
+
+# packages collected by the aptget_* tasks inside apt_transaction()
+env.apt_transaction = None
+
+# timing report of the profile task, see profile()
+env.profile            = False
+env.profile_roots      = []
+env.profile_stack      = []
+env.profile_report_dir = os.path.abspath('./.profile')
+env.profile_skip       = ['profile', 'profile_report', 'profiled', 'profile_bytes',
+                          'command_batch', 'apt_transaction', 'service_changes',
+                          'facts', 'fact_paths', 'fact_files', 'remote_md5',
+                          'sshagent_connect', 'notify_service',
+                          'backup_compressor', 'backup_path', 'backup_exists']
+
+# reloads/restarts collected by notify_service() inside service_changes()
+env.service_changes = None
+env.service_config_tests = {
+    'apache2': 'apache2ctl configtest',
+    'nginx':   'nginx -t',
+}
 
 env.remote_backup_dir = '/var/dumps/django-server-fabfile'
+env.remote_snapshot_dir = '/var/dumps/django-server-fabfile/snapshots'
+env.snapshot_keep       = 7
+
+# compressor for config and snapshot archives, with its thread count (0 is
+# one per core); pigz falls back to gzip on hosts without it. With backup_stream the archives are streamed straight
+# into local_backup_dir/<host> instead of being written to the server.
+env.backup_compressor  = 'pigz'
+env.backup_threads     = 0
+env.backup_stream      = False
+env.backup_compressors = {
+    # name: (compress, decompress, suffix)
+    'gzip': ('gzip -c', 'gzip -dc', '.tar.gz'),
+    'pigz': ('pigz -c -p %(threads)s', 'pigz -dc', '.tar.gz'),
+    'zstd': ('zstd -c -q -T%(threads)s', 'zstd -dc -q', '.tar.zst'),
+}
 env.remote_config_dir = '/var/local/django-server-fabfile'
+env.remote_wheelhouse_dir = '/var/local/django-server-fabfile/wheelhouse'
 
 env.server_groupname               = 'www-data'
 env.webroot_dir                    = '/var/www'
@@ -65,6 +277,13 @@ env.pip_md5  = 'df1eca0abe7643d92b5222240bed15f6'
 # pseudo inline-function for bash
 env.get_cur_timestamp = '$(date +%Y-%m-%d_%H%M%S)'
 
+# maximum number of hosts the *_all tasks work on at the same time,
+# fab's own -z/--pool-size wins if it is given on the command line
+env.parallel_pool_size = 5
+
+# local sshd stand-ins (containers, VMs) for the testbed environment
+env.testbed_hosts = ['127.0.0.1:2201', '127.0.0.1:2202']
+
 
 """
 Environments
@@ -105,14 +324,42 @@ def dev():
     env.server_ip_address = '192.168.0.246'
     common_environment_settings()
 
+def local_database():
+    """
+    Run the database tasks against a PostgreSQL on this machine
+
+    Lets you try load_data or load_new_data on a real dump before
+    pointing them at a server, e.g. ``fab local_database load_new_data``.
+    Dumps are read from local_psql_data_dir and maintenance mode is skipped.
+    """
+    env.settings = 'local'
+    env.db_local = True
+    env.psql_data_dir = env.local_psql_data_dir
+
+def testbed():
+    """
+    Work on local sshd containers or VMs listed in env.testbed_hosts
+    """
+    env.settings = 'test'
+    env.manage_settings = 'conf.dev.settings'
+    env.server_hostname = 'testbed'
+    env.server_domain = 'dev'
+    env.hosts = list(env.testbed_hosts)
+    env.server_ip_address = '127.0.0.1'
+    common_environment_settings()
+
 def common_environment_settings():
     env.user = env.main_username
     env.hostname = '%(server_hostname)s.%(server_domain)s' % env
     env.site_name = env.hostname
     env.staging_site_name = '%(server_hostname)s-staging.%(server_domain)s' % env
-    env.env_path = '/opt/webapps/%(hostname)s' % env
-    env.log_path = '/opt/webapps/%(hostname)s/logs' % env
-    env.proj_root = '%(env_path)s/%(project_name)s' % env
+    # releases go into the virtual environment serving the site, whose
+    # wsgi, vhost and supervisor configs run the code in current
+    env.env_path = '%s/%s' % (env.webapps_location, site_virtual_environment(env.site_name))
+    env.log_path = '%(env_path)s/logs' % env
+    env.releases_path = '%(env_path)s/releases' % env
+    env.current_path = '%(env_path)s/current' % env
+    env.proj_root = '%(current_path)s/%(project_name)s' % env
     env.server_fqdn = env.hostname
     
 """
@@ -149,13 +396,10 @@ def setup():
     require('branch', provided_by=[stable, master, branch])
     
     setup_directories()
-    setup_virtualenv()
-    clone_repo()
-    checkout_latest()
+    build_release()
+    switch_release()
     destroy_database()
-    create_database()
-    load_data()
-    update_requirements()
+    create_database(template=seed_template())
     install_apache_conf()
 
 def setup_directories():
@@ -164,6 +408,7 @@ def setup_directories():
     """
     sshagent_run('mkdir -p %(path)s' % env)
     sshagent_run('mkdir -p %(env_path)s' % env)
+    sshagent_run('mkdir -p %(releases_path)s' % env)
     run ('mkdir -p %(log_path)s;' % env)
     sudo('chgrp -R www-data %(log_path)s; chmod -R g+w %(log_path)s;' % env)
     sshagent_run('ln -s %(log_path)s %(path)s/logs' % env)
@@ -191,7 +436,7 @@ def update_requirements():
     """
     Install the required packages using pip.
     """
-    ve_run("pip install -r %(proj_root)s/requirements.pip" % env)
+    install_requirements(env.current_path, env.proj_root)
 
 def install_apache_conf():
     """
@@ -204,60 +449,228 @@ Commands - deployment
 """
 def deploy():
     """
-    Deploy the latest version of the site to the server and restart Apache2.
+    Deploy the latest version of the site to the server and reload its app server.
     
+    The new release is built next to the running one and swapped in with
+    switch_release(). syncdb always runs against it and its static files
+    are collected before the switch, but the site only goes into
+    maintenance if the release has South migrations to apply.
+
     Does not perform the functions of load_new_data().
     """
     require('settings', provided_by=[production, staging])
     require('branch', provided_by=[stable, master, branch])
     
-    with settings(warn_only=True):
-        maintenance_up()
-
-    checkout_latest()
-    update_requirements()
-    syncdb()
+    build_release()
+
+    with settings(current_path=env.release_path,
+                  proj_root='%(release_path)s/%(project_name)s' % env):
+        migrate = migrations_pending()
+    if migrate:
+        with settings(warn_only=True):
+            maintenance_up()
+    with settings(current_path=env.release_path,
+                  proj_root='%(release_path)s/%(project_name)s' % env):
+        syncdb()
+    collect_static(env.site_name, env.release_path)
+
+    switch_release()
     reset_permissions()
 
-    maintenance_down()
+    if migrate:
+        maintenance_down()
+    else:
+        reload_app_server()
+    cleanup_releases()
     
+@runs_once
+def deploy_all():
+    """
+    Run deploy() against every host in the environment at once.
+    """
+    require('settings', provided_by=[production, staging])
+    require('branch', provided_by=[stable, master, branch])
+
+    fan_out(deploy)
+
+@runs_once
+def rolling_deploy(batch_size=None):
+    """
+    Deploy to env.hosts a batch at a time, keeping the rest in the pool.
+
+    Each batch is drained from the load balancer's upstream, deployed,
+    health checked and put back before the next batch starts. A batch that
+    fails to deploy or to come up healthy stops the rollout and stays
+    drained, also for later runs, so capacity never drops below
+    env.rolling_min_capacity.
+    """
+    require('settings', provided_by=[production, staging])
+    require('branch', provided_by=[stable, master, branch])
+
+    hosts = list(env.hosts)
+    if not hosts:
+        abort("There are no hosts to deploy to.")
+    batch_size = int(batch_size or env.rolling_batch_size)
+    capacity = float(len(hosts) - batch_size) / len(hosts)
+    if capacity < float(env.rolling_min_capacity):
+        abort("Batches of %d leave %d%% of %d hosts serving, the minimum is %d%%." % (
+            batch_size, capacity * 100, len(hosts), float(env.rolling_min_capacity) * 100))
+
+    for start in range(0, len(hosts), batch_size):
+        batch = hosts[start:start + batch_size]
+        down = set(lb_drained_hosts()) | set(batch)
+        if float(len(hosts) - len(down)) / len(hosts) < float(env.rolling_min_capacity):
+            abort("Draining %s would leave too few hosts serving, still drained: %s" % (
+                ', '.join(batch), ', '.join(sorted(down - set(batch)))))
+        lb_drain(batch)
+        with settings(hosts=batch):
+            fan_out(deploy)
+        for host in batch:
+            with settings(host_string=host):
+                if not probe_host():
+                    abort("%s failed its health check, leaving it drained." % host)
+        lb_restore(batch)
+
+def install_lb_upstream():
+    """
+    Install the nginx upstream of all env.hosts on the load balancer.
+
+    The balancer's vhost should proxy_pass to http://<env.lb_upstream_name>.
+    Hosts drained before are put back.
+    """
+    write_lb_upstream([])
+
+def lb_drain(hosts):
+    """
+    Take hosts out of the load balancer's upstream.
+    """
+    write_lb_upstream(set(lb_drained_hosts()) | set(hosts))
+
+def lb_restore(hosts):
+    """
+    Put drained hosts back into the load balancer's upstream.
+    """
+    write_lb_upstream(set(lb_drained_hosts()) - set(hosts))
+
+def lb_drained_hosts():
+    """
+    Helper function.
+    The env.hosts marked down in the upstream file on the load balancer
+
+    The file is the only record of drained hosts, so a host left drained
+    by a failed rollout stays drained until it is restored.
+    """
+    if not env.load_balancer:
+        return []
+    with settings(hide('running', 'stdout', 'warnings'), host_string=env.load_balancer, warn_only=True):
+        output = run('cat %(lb_upstream_path)s 2>/dev/null' % env)
+    down = set(line.split()[1].rsplit(':', 1)[0] for line in output.splitlines()
+               if line.strip().startswith('server ') and line.strip().endswith(' down;'))
+    return [host for host in env.hosts if host.split(':')[0] in down]
+
+def write_lb_upstream(drained):
+    """
+    Upload the upstream block for env.hosts, marking drained hosts down, and reload nginx.
+
+    Does nothing when there is no env.load_balancer.
+    """
+    if not env.load_balancer:
+        return
+    lines = ['upstream %(lb_upstream_name)s {' % env]
+    for host in env.hosts:
+        down = host in drained and ' down' or ''
+        lines.append('    server %s:%s%s;' % (host.split(':')[0], env.lb_backend_port, down))
+    lines.append('}')
+    with settings(host_string=env.load_balancer):
+        with settings(user='root'):
+            put(StringIO.StringIO('\n'.join(lines) + '\n'), env.lb_upstream_path)
+        notify_service('nginx')
+
+def probe_host():
+    """
+    Check that the current host serves env.health_check_path, retrying for a while.
+    """
+    probe = 'curl -fsS -o /dev/null -H "Host: %(site_name)s" http://127.0.0.1%(health_check_path)s' % env
+    for attempt in range(int(env.health_check_retries)):
+        with settings(hide('warnings'), warn_only=True):
+            if run(probe).succeeded:
+                return True
+        time.sleep(float(env.health_check_delay))
+    return False
+
 def maintenance_up():
     """
     Install the Apache maintenance configuration.
+
+    A gunicorn or uwsgi program is stopped instead, nginx answers with
+    a 502 until maintenance_down().
+    """
+    if env.app_server == 'apache':
+        sudo('cp %(proj_root)s/apache/%(hostname)s-maintenance %(apache_config_path)s/%(hostname)s' % env)
+        reload_app_server()
+    else:
+        sudo('supervisorctl stop %s' % site_virtual_environment(env.site_name))
+
+def reload_apache(): 
+    """
+    Gracefully reload the Apache2 server, letting running requests finish.
     """
-    sudo('cp %(proj_root)s/apache/%(hostname)s-maintenance %(apache_config_path)s/%(hostname)s' % env)
-    restart()
+    notify_service('apache2')
 
 def restart_apache(): 
     """
     Restart the Apache2 server.
     """
     sudo('service apache2 restart')
+
+def reload_app_server():
+    """
+    Reload whatever runs the site's Django, see env.app_server.
+
+    Apache is reloaded gracefully; a gunicorn or uwsgi program is
+    restarted by supervisor.
+    """
+    if env.app_server == 'apache':
+        notify_service('apache2')
+    else:
+        sudo('supervisorctl restart %s' % site_virtual_environment(env.site_name))
     
 def maintenance_down():
     """
     Reinstall the normal site configuration.
     """
-    install_apache_conf()
-    restart_apache()
+    if env.app_server == 'apache':
+        install_apache_conf()
+        reload_app_server()
+    else:
+        sudo('supervisorctl start %s' % site_virtual_environment(env.site_name))
     
 """
 Commands - rollback
 """
-def rollback(commit_id):
+def rollback(release=None):
     """
-    Rolls back to specified git commit hash or tag.
+    Point the site back at the previous release, or at the given one.
     
-    There is NO guarantee we have committed a valid dataset for an arbitrary
-    commit hash.
+    Only the code and virtualenv are switched back. There is NO guarantee
+    the database still matches an older release.
     """
     require('settings', provided_by=[production, staging])
-    require('branch', provided_by=[stable, master, branch])
     
-    maintenance_up()
-    checkout_latest()
-    git_reset(commit_id)
-    maintenance_down()
+    releases = finished_releases()
+    with settings(hide('running', 'stdout')):
+        current = run('readlink %(current_path)s' % env).strip().rstrip('/').split('/')[-1]
+    if release is None:
+        older = [name for name in releases if name < current]
+        if not older:
+            abort("There is no release older than %s to roll back to." % current)
+        release = older[-1]
+    elif release not in releases:
+        abort("Unknown release %s, pick one of: %s" % (release, ', '.join(releases)))
+
+    env.release_path = '%s/%s' % (env.releases_path, release)
+    switch_release()
+    reload_app_server()
     
 def git_reset(commit_id):
     """
@@ -266,44 +679,297 @@ def git_reset(commit_id):
     env.commit_id = commit_id
     sshagent_run("cd %(proj_root)s; git reset --hard %(commit_id)s" % env)
 
+"""
+Commands - releases
+"""
+def build_release():
+    """
+    Build a new release next to the running one.
+
+    Each release lives in releases/<timestamp> under env.env_path and is a
+    fresh checkout of the branch plus its own virtualenv with the
+    requirements installed. Nothing the running site uses is touched.
+
+    A release only counts once it is marked complete, see
+    finished_releases(); a failed build is removed again.
+    """
+    require('branch', provided_by=[stable, master, branch])
+
+    env.release = time.strftime('%Y%m%d%H%M%S')
+    env.release_path = '%(releases_path)s/%(release)s' % env
+    try:
+        sshagent_run('git clone -b %(branch)s git@github.com:adamfeuer/%(project_name)s.git %(release_path)s/%(project_name)s' % env)
+        run('virtualenv -p %(python)s --no-site-packages %(release_path)s' % env)
+        install_requirements(env.release_path, '%(release_path)s/%(project_name)s' % env)
+        if env.app_server != 'apache':
+            run('%(release_path)s/bin/pip install %(app_server)s' % env)
+        # the app config and keys are shared by all releases
+        run('ln -s %(env_path)s/%(appname)s.config %(release_path)s/%(appname)s.config' % env)
+        run('[ ! -d %(env_path)s/%(appname)s/keys ] || '
+            'ln -s %(env_path)s/%(appname)s/keys %(release_path)s/%(project_name)s/keys' % env)
+    except (Exception, SystemExit):
+        with settings(warn_only=True):
+            run('rm -rf %(release_path)s' % env)
+        raise
+    run('touch %(release_path)s/.release-complete' % env)
+
+def finished_releases():
+    """
+    Helper function.
+    The names of the completely built releases, oldest first
+    """
+    with settings(hide('running', 'stdout')):
+        output = run('for release in %(releases_path)s/*; do '
+                     '[ -e $release/.release-complete ] && basename $release; done; true' % env)
+    return sorted(output.split())
+
+def switch_release():
+    """
+    Atomically point the current symlink at env.release_path.
+    """
+    run('ln -sfn %(release_path)s %(current_path)s.new && mv -T %(current_path)s.new %(current_path)s' % env)
+
+def cleanup_releases():
+    """
+    Delete all but the newest env.keep_releases releases.
+
+    Leftovers of builds that never completed are deleted as well.
+    """
+    releases = finished_releases()
+    with settings(hide('running', 'stdout')):
+        current = run('readlink %(current_path)s' % env).strip().rstrip('/').split('/')[-1]
+        everything = run('ls -1 %(releases_path)s' % env).split()
+    keep = set(releases[-int(env.keep_releases):] + [current])
+    stale = [name for name in everything if name not in keep]
+    if stale:
+        with cd(env.releases_path):
+            run('rm -rf %s' % ' '.join(stale))
+
+def migrations_pending():
+    """
+    Check whether South has unapplied migrations for the release in proj_root.
+    """
+    with settings(hide('running', 'warnings'), warn_only=True):
+        result = ve_run('%(proj_root)s/bin/manage.py migrate --list --settings=%(manage_settings)s | grep -q "( )"' % env)
+    return result.succeeded
+
 """
 Commands - data
 """
-def load_new_data():
+def load_new_data(swap=True):
     """
     Erase the current database and load new data from the SQL dump file.
+
+    The data is loaded into a shadow database while the site keeps running
+    on the current one, and maintenance mode only covers swapping it in,
+    see swap_database(). Pass swap=False to drop and reload the database
+    in maintenance mode instead.
     """
-    require('settings', provided_by=[production, staging])
+    require('settings', provided_by=[production, staging, local_database])
     
-    maintenance_up()
-    destroy_database()
-    create_database()
-    load_data()
-    maintenance_down()
+    if not boolean_arg(swap):
+        template = seed_template()
+        maintenance_up()
+        destroy_database()
+        create_database(template=template)
+        maintenance_down()
+        return
+
+    shadow = env.project_name + '_shadow'
+    with settings(warn_only=True):
+        db_run('dropdb %s' % shadow)
+    create_database(shadow, seed_template())
+    swap_database(shadow)
     
-def create_database():
+def create_database(database=None, template='template_postgis'):
     """
     Creates the user and database for this project.
+
+    The user is only created if it doesn't exist yet, so this also adds
+    more databases for it, like the shadow database of load_new_data().
+    The database is a copy of template, see seed_template().
     """
-    sshagent_run('echo "CREATE USER %(project_name)s WITH PASSWORD \'%(database_password)s\';" | psql postgres' % env)
-    sshagent_run('createdb -O %(project_name)s %(project_name)s -T template_postgis' % env)
+    database = database or env.project_name
+    db_run('psql postgres -tAc "SELECT 1 FROM pg_roles WHERE rolname = \'%(project_name)s\'" | grep -q 1'
+           ' || psql postgres -c "CREATE USER %(project_name)s WITH PASSWORD \'%(database_password)s\';"' % env)
+    db_run('createdb -O %s %s -T %s' % (env.project_name, database, template))
     
 def destroy_database():
     """
     Destroys the user and database for this project.
     
-    Will not cause the fab to fail if they do not exist.
+    Will not cause the fab to fail if they do not exist. The user stays
+    while cached seed templates hold objects of it, see clear_seed_templates().
     """
     with settings(warn_only=True):
-        sshagent_run('dropdb %(project_name)s' % env)
-        sshagent_run('dropuser %(project_name)s' % env)
+        db_run('dropdb %(project_name)s' % env)
+        db_run('dropdb %(project_name)s_old' % env)
+        db_run('dropuser %(project_name)s' % env)
         
-def load_data():
+def load_data(database=None):
     """
     Loads data from the repository into PostgreSQL.
+
+    A custom-format dump.custom (``pg_dump -Fc``, see dump_database) is
+    used when there is one, otherwise the plain dump.sql.
+    """
+    database = database or env.project_name
+    restore_dump(database, seed_dump())
+    db_run('psql -q %s < %s/finish_init.sql' % (database, psql_data_dir()))
+
+def seed_template():
+    """
+    Helper function.
+    Name of a template database holding the seed data, built if needed
+
+    The template is keyed by the checksum of the seed dump and
+    finish_init.sql, so createdb -T can copy it in seconds until the seed
+    data changes. Only then is a new one loaded, and the stale ones of
+    this project are dropped.
+    """
+    dump = seed_dump()
+    with settings(hide('running')):
+        checksum = db_run('cat %s %s/finish_init.sql | md5sum' % (dump, psql_data_dir()), capture=True)
+    template = '%s_seed_%s' % (env.project_name, checksum.split()[0][:12])
+
+    if not database_exists(template):
+        clear_seed_templates()
+        create_database(template)
+        load_data(template)
+    return template
+
+def clear_seed_templates():
     """
-    sshagent_run('psql -q %(project_name)s < %(path)s/repository/data/psql/dump.sql' % env)
-    sshagent_run('psql -q %(project_name)s < %(path)s/repository/data/psql/finish_init.sql' % env)
+    Drop the cached seed data templates of this project.
+    """
+    with settings(hide('running', 'warnings'), warn_only=True):
+        templates = db_run('psql -lqtA | cut -d "|" -f 1 | grep "^%(project_name)s_seed_"' % env,
+                           capture=True)
+    with settings(warn_only=True):
+        for template in templates.split():
+            db_run('dropdb %s' % template)
+
+def dump_database(dump_path=None):
+    """
+    Dump the project database in custom format for load_data.
+
+    Writes to remote_backup_dir/<project_name>.custom by default; copy it
+    to data/psql/dump.custom to make it the seed data.
+    """
+    dump_path = dump_path or '%(remote_backup_dir)s/%(project_name)s.custom' % env
+    db_run('pg_dump -Fc -f %s %s' % (dump_path, env.project_name))
+    return dump_path
+
+def restore_dump(database, dump_path):
+    """
+    Helper function.
+    Load a plain SQL or custom-format dump into database
+
+    Custom-format dumps go through pg_restore with env.pg_restore_jobs
+    parallel jobs. It creates the tables bare, loads the data, and only
+    then builds the indexes, constraints and triggers, all in parallel.
+    """
+    if dump_path.endswith('.sql'):
+        db_run('psql -q %s < %s' % (database, dump_path))
+    else:
+        jobs = env.pg_restore_jobs or '$(nproc)'
+        db_run('pg_restore --exit-on-error --no-owner --role=%s -j %s -d %s %s' % (
+            env.project_name, jobs, database, dump_path))
+
+def swap_database(shadow):
+    """
+    Helper function.
+    Put the shadow database in place of the project database by renaming
+
+    Renaming is instant whatever the size of the data, so the site is only
+    in maintenance for this one statement. PostgreSQL won't rename a
+    database in use, so new connections to the project database are
+    revoked and the sessions still on it closed until none is left,
+    giving up after swap_session_timeout seconds. The replaced database
+    is kept as <project_name>_old until the next swap.
+    """
+    old = env.project_name + '_old'
+    with settings(warn_only=True):
+        db_run('dropdb %s' % old)
+
+    if not database_exists(env.project_name):
+        db_run('psql -q postgres -c "ALTER DATABASE %s RENAME TO %s"' % (shadow, env.project_name))
+        return
+
+    # pg_stat_activity.procpid became pid in 9.2
+    version = int(db_run('psql -tA postgres -c "SHOW server_version_num"', capture=True).strip())
+    values = {
+        'project': env.project_name,
+        'old': old,
+        'shadow': shadow,
+        'pid': version >= 90200 and 'pid' or 'procpid',
+    }
+    if not env.db_local:
+        maintenance_up()
+    db_run('psql -q postgres -c "REVOKE CONNECT ON DATABASE %(project)s FROM PUBLIC, %(project)s"' % values)
+    for attempt in range(int(env.swap_session_timeout)):
+        sessions = db_run('psql -tA postgres -c "'
+                          'SELECT count(pg_terminate_backend(%(pid)s)) FROM pg_stat_activity'
+                          ' WHERE datname = \'%(project)s\' AND %(pid)s <> pg_backend_pid()"' % values,
+                          capture=True)
+        if sessions.strip() == '0':
+            break
+        time.sleep(1)
+    else:
+        db_run('psql -q postgres -c "GRANT CONNECT ON DATABASE %(project)s TO PUBLIC, %(project)s"' % values)
+        if not env.db_local:
+            maintenance_down()
+        abort("Sessions kept connecting to %(project)s, the database was not swapped." % values)
+    db_run('psql -q postgres -c "'
+           'ALTER DATABASE %(project)s RENAME TO %(old)s;'
+           ' ALTER DATABASE %(shadow)s RENAME TO %(project)s;"' % values)
+    if not env.db_local:
+        maintenance_down()
+
+def boolean_arg(value):
+    """
+    Helper function.
+    A task argument as a boolean; from the command line every value is a
+    string, so 'False', 'no', 'off', '0' and '' are false
+    """
+    if isinstance(value, basestring):
+        return value.strip().lower() not in ('false', 'no', 'off', '0', '')
+    return bool(value)
+
+def database_exists(database):
+    """
+    Helper function.
+    Whether PostgreSQL has a database with this name
+    """
+    with settings(hide('warnings'), warn_only=True):
+        return db_run('psql -lqtA | cut -d "|" -f 1 | grep -qx %s' % database).succeeded
+
+def seed_dump():
+    """
+    Helper function.
+    The dump load_data reads: dump.custom if there is one, else dump.sql
+    """
+    custom = psql_data_dir() + '/dump.custom'
+    with settings(hide('warnings'), warn_only=True):
+        if db_run('[ -e %s ]' % custom).succeeded:
+            return custom
+    return psql_data_dir() + '/dump.sql'
+
+def psql_data_dir():
+    """
+    Helper function.
+    Where the seed dumps are read from
+    """
+    return env.psql_data_dir or '%(path)s/repository/data/psql' % env
+
+def db_run(cmd, capture=False):
+    """
+    Helper function.
+    Runs a database command on the server, or here under local_database()
+    """
+    if env.db_local:
+        return local(cmd, capture=capture)
+    return sshagent_run(cmd, capture=capture)
     
 """
 Commands - miscellaneous
@@ -338,8 +1004,7 @@ def shiva_the_destroyer():
     with settings(warn_only=True):
         sshagent_run('rm -Rf %(path)s' % env)
         sshagent_run('rm -Rf %(log_path)s' % env)
-        sshagent_run('dropdb %(project_name)s' % env)
-        sshagent_run('dropuser %(project_name)s' % env)
+        destroy_database()
         sudo('rm %(apache_config_path)s' % env)
         restart_apache()
 
@@ -358,30 +1023,37 @@ def setup_server(update=True):
     setup_users()
     setup_web_server()
 
+@runs_once
+def setup_server_all(update=True):
+    """
+    Bootstrap every host in the environment at once, see setup_server()
+    """
+    fan_out(setup_server, update)
 
 def setup_server_init(update=True): 
     # install the root user, config and working dirs
     init_system()
     install_master_users()
-    aptget_misc_deps()
-    if update:
-        aptget_software_updates()
-    aptget_compiler()
-    aptget_common_dev_headers()
-    aptget_git()
+    aptget_server_packages(update)
 
 def setup_web_server(): 
     """
     Installs and configures web servers
+
+    Apache and nginx are reloaded once at the end, see service_changes().
     """
     set_fqdn()
     setup_python() # includes virtualenv, django and wsgi
     install_webroot()
     setup_webapps_location()
     setup_ssl_cert()
-    setup_apache()
-    setup_nginx()
-    make_virtual_environments()
+    with service_changes():
+        if env.app_server == 'apache':
+            setup_apache()
+        setup_nginx()
+        if env.pgbouncer:
+            setup_pgbouncer()
+        make_virtual_environments()
       # setup databases
 
 
@@ -414,7 +1086,6 @@ def init_system():
     home directory skeleton for new users. Creates backup
     and config directories.
     """
-    regen_tarballs()
     init_root_user();
 
     with settings(hide('warnings'), warn_only=True, user='root'):
@@ -437,21 +1108,34 @@ def setup_apache():
     """
     Installs and configures Apache HTTPD
     """
-    aptget_apache()
-    a2enmod_rewrite()
-    a2enmod_proxy()
-    a2enmod_wsgi()
-    install_apache_config()
-    setup_apache_logs()
-    restart_apache()
+    with service_changes():
+        aptget_apache()
+        a2enmod_rewrite()
+        a2enmod_proxy()
+        a2enmod_wsgi()
+        install_apache_config()
+        setup_apache_logs()
 
 
 def setup_nginx(): 
     """
     Installs and configures nginx
     """
-    aptget_nginx()
-    install_nginx_config()
+    with service_changes():
+        aptget_nginx()
+        install_nginx_config()
+
+# Databases
+def setup_pgbouncer(): 
+    """
+    Installs and configures PgBouncer in front of PostgreSQL
+
+    The Django apps then connect to the pooler, which keeps at most
+    pgbouncer_pool_size server connections for all the WSGI processes.
+    """
+    with service_changes():
+        aptget_pgbouncer()
+        install_pgbouncer_config()
 
 
 
@@ -508,11 +1192,15 @@ def install_master_users():
        clone_root_pubkey(env.deploy_username, '/home/%(deploy_username)s' % env)
        clone_root_pubkey(env.main_username, '/home/%(main_username)s' % env)
        # sudo permissions for main user - we will use this user from now on
-       run('adduser %(main_username)s sudo' % env)
+       add_user_to_group(env.main_username, 'sudo')
        env.sudo_conf = "%(main_username)s ALL = (root) NOPASSWD: ALL" % env
-       run('echo "%(sudo_conf)s" >> /tmp/%(main_username)s' % env)
-       run('chmod 0440 /tmp/%(main_username)s' % env)
-       run('mv /tmp/%(main_username)s /etc/sudoers.d' % env)
+       sudoers_file = '/etc/sudoers.d/%(main_username)s' % env
+       if remote_md5(sudoers_file) == hashlib.md5(env.sudo_conf + '\n').hexdigest():
+           return
+       with command_batch() as batch:
+           batch.append('echo "%(sudo_conf)s" > /tmp/%(main_username)s' % env)
+           batch.append('chmod 0440 /tmp/%(main_username)s' % env)
+           batch.append('mv /tmp/%(main_username)s /etc/sudoers.d' % env)
 
 def clean_master_users(): 
     """
@@ -533,17 +1221,32 @@ def install_team_users():
     If this is a shared workgroup server with multiple user
     accounts, then set up each initial user account with
     proper group and permissions to work on the same files
-    """
-    sudo('addgroup %(team_groupname)s' % env)
-    sudo('adduser %(deploy_username)s %(team_groupname)s' % env)
-    sudo('adduser %(deploy_username)s %(server_groupname)s' % env)
-    sudo('adduser %(main_username)s %(team_groupname)s' % env)
-    sudo('adduser %(main_username)s %(server_groupname)s' % env)
-    for name in env.team_users:
-        add_custom_user(name, env.team_password)
-        with settings(team_user_name=name):
-            sudo('adduser %(team_user_name)s %(server_groupname)s' % env)
-            sudo('adduser %(team_user_name)s %(team_groupname)s' % env)
+
+    Users and memberships that already exist are skipped and everything
+    else is done in one remote script, however big the team.
+    """
+    groups = facts()['groups']
+    new_users = [name for name in env.team_users if name not in facts()['users']]
+    wanted_groups = [env.team_groupname, env.server_groupname]
+
+    with command_batch(use_sudo=True) as batch:
+        if env.team_groupname not in groups:
+            batch.append('addgroup %(team_groupname)s' % env)
+        for name in new_users:
+            batch.append('useradd --skel %s/skel --create-home --home-dir /home/%s --shell /bin/bash %s' % (
+                env.remote_config_dir, name, name))
+        if new_users:
+            passwords = ['%s:%s' % (name, env.team_password) for name in new_users]
+            batch.append("printf '%%s\\n' %s | chpasswd" % ' '.join(shell_quote(p) for p in passwords))
+        for name in [env.deploy_username, env.main_username] + env.team_users:
+            missing = [group for group in wanted_groups if name not in groups.get(group, ())]
+            if missing:
+                batch.append('usermod -a -G %s %s' % (','.join(missing), name))
+
+    facts()['users'].update(new_users)
+    for group in wanted_groups:
+        groups.setdefault(group, set()).update(
+            [env.deploy_username, env.main_username] + env.team_users)
 
 def clean_team_users(): 
     """
@@ -564,12 +1267,17 @@ def install_team_sudoers():
     cmd_alias   = 'Cmnd_Alias WEB_SERVER_CMDS = %s' % alias_list
     sudoer_line = '%(team_groupname)s ALL=(ALL) NOPASSWD: WEB_SERVER_CMDS' % env
 
+    sudoers_file = '/etc/sudoers.d/%(team_groupname)s' % env
+    if remote_md5(sudoers_file) == hashlib.md5(cmd_alias + '\n' + sudoer_line + '\n').hexdigest():
+        return
+
     with settings(cmd_alias=cmd_alias, sudoer_line=sudoer_line):
-        sudo("echo '%(cmd_alias)s' > /tmp/%(team_groupname)s" % env)
-        sudo("echo '%(sudoer_line)s' >> /tmp/%(team_groupname)s" % env)
-        sudo("chmod 440 /tmp/%(team_groupname)s" % env)
-        sudo("chown root:root /tmp/%(team_groupname)s" % env)
-        sudo("mv /tmp/%(team_groupname)s /etc/sudoers.d" % env)
+        with command_batch(use_sudo=True) as batch:
+            batch.append("echo '%(cmd_alias)s' > /tmp/%(team_groupname)s" % env)
+            batch.append("echo '%(sudoer_line)s' >> /tmp/%(team_groupname)s" % env)
+            batch.append("chmod 440 /tmp/%(team_groupname)s" % env)
+            batch.append("chown root:root /tmp/%(team_groupname)s" % env)
+            batch.append("mv /tmp/%(team_groupname)s /etc/sudoers.d" % env)
 
 def clean_team_sudoers(): 
     """
@@ -584,11 +1292,7 @@ def install_etc_skel():
     Uploads the new user skeleton directory to the remote_config_dir
     """
     with settings(user = 'root'):
-        put('%(local_tar_dir)s/skel.tar.gz' % env, env.remote_config_dir)
-    with cd(env.remote_config_dir):
-        sudo('tar -zxf skel.tar.gz')
-
-        sudo('rm -rf skel.tar.gz')
+        stream_tree('%(local_config_dir)s/skel' % env, '%(remote_config_dir)s/skel' % env)
 
 
 def clean_etc_skel(): 
@@ -601,26 +1305,165 @@ def clean_etc_skel():
     sudo('rm -rf %(remote_config_dir)s/skel' % env)
 
 
+# Snapshots
+def take_snapshot(name, source_dir):
+    """
+    Helper function.
+    Snapshot a remote directory into remote_snapshot_dir/name/<timestamp>
+
+    Each snapshot is a full tree, but files unchanged since the previous
+    snapshot are hard links into it, so a snapshot costs only the changed
+    files in time and disk. The newest snapshot_keep snapshots are kept
+    and ``latest`` points at the newest one.
+    """
+    snapshots = '%s/%s' % (env.remote_snapshot_dir, name)
+    with command_batch(use_sudo=True) as batch:
+        batch.append('mkdir -p %s' % snapshots)
+        batch.append('stamp=$(date +%Y%m%d-%H%M%S)')
+        batch.append('link_dest=""; if [ -d %s/latest ]; then link_dest="--link-dest=%s/latest/"; fi' % (snapshots, snapshots))
+        batch.append('rsync -a --delete $link_dest %s/ %s/$stamp/' % (source_dir.rstrip('/'), snapshots))
+        batch.append('ln -sfn $stamp %s/latest' % snapshots)
+        batch.append('ls -1d %s/2* | head -n -%d | xargs -r rm -rf' % (snapshots, int(env.snapshot_keep)))
+
+def restore_snapshot(name, target_dir, stamp='latest'):
+    """
+    Helper function.
+    Bring target_dir back to the state of a snapshot taken by take_snapshot()
+
+    rsync only rewrites the files that differ from the snapshot and
+    deletes the ones created since, so restoring is quick however big the
+    tree is. Returns False if there is no such snapshot.
+    """
+    snapshot = '%s/%s/%s' % (env.remote_snapshot_dir, name, stamp)
+    with settings(hide('warnings'), warn_only=True):
+        if sudo('[ -d %s ]' % snapshot).failed:
+            return False
+    with command_batch(use_sudo=True) as batch:
+        batch.append('mkdir -p %s' % target_dir)
+        batch.append('rsync -a --delete %s/ %s/' % (snapshot, target_dir.rstrip('/')))
+    return True
+
+def export_snapshot(name='webroot', stamp='latest'):
+    """
+    Stream a compressed archive of a snapshot into local_backup_dir
+
+    The archive is compressed on the server with backup_compressor on
+    every core and written straight into local_backup_dir/<host>, so it
+    never takes space on the server.
+    """
+    compress, decompress, suffix = backup_compressor()
+    local_dir = os.path.join(env.local_backup_dir, env.host)
+    if not os.path.isdir(local_dir):
+        os.makedirs(local_dir)
+    local_path = os.path.join(local_dir, '%s-%s%s' % (name, stamp, suffix))
+    fetch_stream('tar -cf - -C %s/%s/%s . | %s' % (env.remote_snapshot_dir, name, stamp, compress),
+                 local_path, use_sudo=True)
+    return local_path
+
+def list_snapshots(name='webroot'):
+    """
+    List the snapshots kept for webroot or home_<user>, oldest first
+    """
+    with settings(hide('warnings'), warn_only=True):
+        sudo('ls -1 %s/%s | grep -v latest' % (env.remote_snapshot_dir, name))
+
+# Compressed backups
+def backup_compressor():
+    """
+    Helper function.
+    The (compress, decompress, suffix) commands for env.backup_compressor
+
+    gzip stands in for a compressor that isn't installed if it writes
+    the same format, as pigz does on hosts set up before it was added.
+    """
+    name = env.backup_compressor
+    if (name not in facts()['packages'] and
+            env.backup_compressors[name][2] == env.backup_compressors['gzip'][2]):
+        name = 'gzip'
+    compress, decompress, suffix = env.backup_compressors[name]
+    threads = env.backup_threads or '$(nproc)'
+    return compress % {'threads': threads}, decompress, suffix
+
+def backup_path(name):
+    """
+    Helper function.
+    Where the archive called name lives, locally when backups are streamed
+    """
+    suffix = backup_compressor()[2]
+    if env.backup_stream:
+        return os.path.join(env.local_backup_dir, env.host, name + suffix)
+    return '%s/%s%s' % (env.remote_backup_dir, name, suffix)
+
+def backup_exists(name):
+    """
+    Helper function.
+    Whether the archive called name has been taken already
+    """
+    if env.backup_stream:
+        return os.path.exists(backup_path(name))
+    with settings(hide('warnings'), warn_only=True):
+        return sudo('[ -e %s ]' % backup_path(name)).succeeded
+
+def backup_dir(parent_dir, dir_name, name):
+    """
+    Helper function.
+    Archive parent_dir/dir_name as name with the multi-core backup compressor
+
+    The archive goes to remote_backup_dir, or over the ssh channel straight
+    into local_backup_dir/<host> when env.backup_stream is set.
+    """
+    compress, decompress, suffix = backup_compressor()
+    path = backup_path(name)
+    pipeline = 'tar -cf - -C %s %s | %s' % (parent_dir, dir_name, compress)
+    if env.backup_stream:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        fetch_stream(pipeline, path, use_sudo=True)
+    else:
+        sudo('mkdir -p %s && set -o pipefail && %s > %s.part && mv %s.part %s' % (
+            env.remote_backup_dir, pipeline, path, path, path))
+    return path
+
+def restore_dir(parent_dir, name):
+    """
+    Helper function.
+    Unpack the archive called name into parent_dir
+
+    Archives on the server are removed once restored, like the tarballs
+    they replace; streamed archives are kept in local_backup_dir.
+    """
+    compress, decompress, suffix = backup_compressor()
+    path = backup_path(name)
+    if env.backup_stream:
+        send_stream(path, '%s | tar -xf - -C %s' % (decompress, parent_dir), use_sudo=True)
+    else:
+        sudo('set -o pipefail && %s < %s | tar -xf - -C %s && rm -f %s' % (
+            decompress, path, parent_dir, path))
+
 # Servers 
 def backup_webroot(): 
+    """
+    Take an incremental snapshot of the webroot
+    """
     with settings(hide('warnings'), warn_only=True):
         if len(env.webroot_dir) and run('[ -e %(webroot_dir)s ]' % env).succeeded:
-            with cd(env.webroot_dir):
-                sudo('tar -czf %(remote_backup_dir)s/webroot.tar.gz ./' % env)
+            take_snapshot('webroot', env.webroot_dir)
 
-def restore_webroot(): 
-    with settings(hide('warnings'), warn_only=True):
-        if run('[ -e %(remote_backup_dir)s/webroot.tar.gz ]' % env).succeeded:
-            sudo('rm -rf %(webroot_dir)s' % env)
-            sudo('mkdir -p %(webroot_dir)s' % env)
-            sudo('mv %(remote_backup_dir)s/webroot.tar.gz %(webroot_dir)s' % env)
-            with cd(env.webroot_dir):
-                sudo('tar -zxf webroot.tar.gz')
-                sudo('rm -rf webroot.tar.gz')
+def restore_webroot(stamp='latest'): 
+    """
+    Restore the webroot from a snapshot, the latest one by default
+    """
+    restore_snapshot('webroot', env.webroot_dir, stamp)
 
 def install_webroot(): 
-    backup_webroot()
-    sudo('rm -rf %(webroot_dir)s' % env)
+    """
+    Create the webroot, unless it exists
+
+    An existing webroot holds collected static files and vhost content,
+    see collect_static() and backup_webroot(), so it is left alone.
+    """
+    if remote_exists(env.webroot_dir):
+        return
     sudo('mkdir -p %(webroot_dir)s/apache' % env)
 
     # allow team and web server to edit files in webroot
@@ -631,31 +1474,25 @@ def backup_apache_config():
     """
     Backs up the apache config to the backup directory
     """
-    with settings(hide('warnings'), warn_only=True):
-        if sudo ('[ ! -e %(remote_backup_dir)s/apache2.tar.gz ]' % env).succeeded:
-            with cd('/etc'):
-                sudo('tar -czf %(remote_backup_dir)s/apache2.tar.gz apache2' % env)
+    if not backup_exists('apache2'):
+        backup_dir('/etc', 'apache2', 'apache2')
 
 def restore_apache_config(): 
     """
     Restore original apache config from backup if the backup exists
     """
-    with settings(hide('warnings'), warn_only=True):
-        if sudo('[ -e %(remote_backup_dir)s/apache2.tar.gz ]' % env).succeeded:
-            # remove custom apache config
-            sudo('rm -rf /etc/apache2')
-            sudo('mv %(remote_backup_dir)s/apache2.tar.gz /etc' % env)
-            with cd('/etc'):
-                sudo('tar -zxf apache2.tar.gz')
-                sudo('rm -rf apache2.tar.gz')
+    if backup_exists('apache2'):
+        # remove custom apache config
+        sudo('rm -rf /etc/apache2')
+        restore_dir('/etc', 'apache2')
 
 def install_apache_config(): 
     """
     Setup Apache config files
     """
     backup_apache_config()
-    with settings(user='root'):
-        put(local_path="conf/wsgi/apache/ports.conf", remote_path="/etc/apache2")
+    if sync_files([("conf/wsgi/apache/ports.conf", "/etc/apache2/ports.conf")]):
+        notify_service('apache2')
     # re-chown the webroot since we uploaded localhost as root
     configure_open_share(env.deploy_username, env.server_groupname, env.webroot_dir)
     # allow team and or admins to add and edit vhosts
@@ -666,42 +1503,325 @@ def backup_nginx_config():
     """
     Backs up the nginx configuration dir into the backup directory
     """
-    if sudo('[ ! -e %(remote_backup_dir)s/nginx.tar.gz ]' % env).succeeded:
-        with cd('/etc'):
-            sudo('tar -czf %(remote_backup_dir)s/nginx.tar.gz nginx' % env)
+    if not backup_exists('nginx'):
+        backup_dir('/etc', 'nginx', 'nginx')
 
 def restore_nginx_config(): 
     """
     Restore original nginx config from backup if the backup exists
     """
-    with settings(hide('warnings'), warn_only=True):
-        if sudo('[ -e %(remote_backup_dir)s/nginx.tar.gz ]' % env).succeeded:
-            # remove custom apache config
-            sudo('rm -rf /etc/nginx')
-            sudo('mv %(remote_backup_dir)s/nginx.tar.gz /etc' % env)
-            with cd('/etc'):
-                sudo('tar -zxf nginx.tar.gz')
-                sudo('rm -rf nginx.tar.gz')
+    if backup_exists('nginx'):
+        # remove custom nginx config
+        sudo('rm -rf /etc/nginx')
+        restore_dir('/etc', 'nginx')
+
+def install_pgbouncer_config(): 
+    """
+    Setup PgBouncer to pool the connections to the project database
+
+    The user list holds the project_name user with the md5 of
+    database_password, the same credentials the Django apps use.
+    """
+    replacements = {
+        'PROJECTNAME': env.project_name,
+        'PASSWORDHASH': 'md5' + hashlib.md5(env.database_password + env.project_name).hexdigest(),
+        'DATABASEHOST': env.database_host,
+        'DATABASEPORT': env.database_port,
+        'PGBOUNCERPORT': env.pgbouncer_port,
+        'PGBOUNCERPOOLMODE': env.pgbouncer_pool_mode,
+        'PGBOUNCERPOOLSIZE': env.pgbouncer_pool_size,
+        'PGBOUNCERMAXCLIENTS': env.pgbouncer_max_clients,
+    }
+    changed = sync_files([
+        (render_template('conf/pgbouncer/pgbouncer.ini', replacements), '/etc/pgbouncer/pgbouncer.ini'),
+        (render_template('conf/pgbouncer/userlist.txt', replacements), '/etc/pgbouncer/userlist.txt'),
+    ])
+    if changed:
+        sudo('chown postgres:postgres /etc/pgbouncer/pgbouncer.ini /etc/pgbouncer/userlist.txt')
+        sudo('chmod 640 /etc/pgbouncer/userlist.txt')
+        # older packages ship with the daemon disabled
+        sudo('sed -i "s/^START=0/START=1/" /etc/default/pgbouncer 2>/dev/null; true')
+        notify_service('pgbouncer', 'restart')
+
+def postgresql_tuning():
+    """
+    Helper function.
+    The tune_postgresql template values for this host's RAM, cores and disk
+
+    Follows the usual rules of thumb: a quarter of the RAM for
+    shared_buffers, three quarters assumed to be file cache, and work_mem
+    sized so pg_max_connections sorting at once can't push the host into
+    swap. SSDs get a cheaper random_page_cost and more concurrent I/O.
+    """
+    memory = facts()['memory_mb']
+    cores = facts()['cores']
+    ssd = facts()['ssd']
+    version = map(int, facts()['postgresql_versions'][-1].split('.'))
+
+    shared_buffers = min(memory / 4, 8192)
+    if version >= [9, 5]:
+        checkpoints = 'min_wal_size = 1GB\nmax_wal_size = 4GB'
+    else:
+        checkpoints = 'checkpoint_segments = 32'
+    return {
+        'PGMEMORYMB': memory,
+        'PGCORES': cores,
+        'PGDISK': ssd and 'SSD' or 'rotating',
+        'PGMAXCONNECTIONS': env.pg_max_connections,
+        'PGSHAREDBUFFERS': '%dMB' % shared_buffers,
+        'PGEFFECTIVECACHESIZE': '%dMB' % (memory * 3 / 4),
+        'PGWORKMEM': '%dkB' % max((memory - shared_buffers) * 1024 / (int(env.pg_max_connections) * 3), 4096),
+        'PGMAINTENANCEWORKMEM': '%dMB' % min(max(memory / 16, 64), 2048),
+        'PGCHECKPOINTS': checkpoints,
+        'PGRANDOMPAGECOST': ssd and '1.1' or '4.0',
+        'PGIOCONCURRENCY': ssd and 200 or 2,
+        'PGAUTOVACUUMWORKERS': max(3, cores / 2),
+        'PGAUTOVACUUMCOSTLIMIT': ssd and 2000 or 200,
+    }
+
+def tune_postgresql(dry_run=False): 
+    """
+    Size PostgreSQL for the host's RAM, cores and disk type
+
+    Renders conf/postgresql/tuning.conf into the conf.d dir of the newest
+    installed PostgreSQL and includes it at the end of postgresql.conf,
+    backing up the original config first. Settings that need it get a
+    restart, the rest a reload. With dry_run the diff against the
+    installed file is only shown.
+
+    The config is parsed with postgres -C first where it has it (9.2 on).
+    A restart that fails puts the previous tuning back and starts
+    PostgreSQL on it again, so it is done at once even inside
+    service_changes().
+
+    Before 9.3 PostgreSQL allocates shared_buffers as System V shared
+    memory, so kernel.shmmax and kernel.shmall are raised to half the RAM
+    first, the kernel default of 32MB holds little more than the stock
+    shared_buffers.
+    """
+    versions = facts()['postgresql_versions']
+    if not versions:
+        abort("PostgreSQL is not installed, see aptget_databases.")
+    config_dir = '/etc/postgresql/%s/main' % versions[-1]
+    tuning_path = config_dir + '/conf.d/django-server.conf'
+    rendered_path = render_template('conf/postgresql/tuning.conf', postgresql_tuning())
+
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        installed = sudo('cat %s 2>/dev/null' % tuning_path)
+    rendered = open(rendered_path).read()
+    if boolean_arg(dry_run):
+        diff = difflib.unified_diff(installed.splitlines(), rendered.splitlines(),
+                                    tuning_path, 'conf/postgresql/tuning.conf', lineterm='')
+        print '\n'.join(diff) or 'PostgreSQL tuning is up to date.'
+        return
+
+    backup_postgresql_config()
+    if map(int, versions[-1].split('.')) < [9, 3]:
+        shmmax = facts()['memory_mb'] / 2 * 1024 * 1024
+        with settings(hide('running', 'stdout')):
+            current = int(sudo('sysctl -n kernel.shmmax'))
+        if current < shmmax:
+            sudo('echo "kernel.shmmax = %d" > /etc/sysctl.d/60-postgresql-shm.conf && '
+                 'echo "kernel.shmall = %d" >> /etc/sysctl.d/60-postgresql-shm.conf && '
+                 'sysctl -q -p /etc/sysctl.d/60-postgresql-shm.conf' % (shmmax, shmmax / 4096))
+    # include_dir only exists from 9.3 on, include works everywhere
+    sudo('mkdir -p %s/conf.d' % config_dir)
+    sudo('grep -qF "include \'%s\'" %s/postgresql.conf || '
+         'echo "include \'%s\'" >> %s/postgresql.conf' % (tuning_path, config_dir, tuning_path, config_dir))
+    changed = sync_files([(rendered_path, tuning_path)], keep_previous=True)
+    if changed:
+        restart_only = ('max_connections', 'shared_buffers', 'wal_buffers', 'autovacuum_max_workers')
+        old = dict(line.split(' = ', 1) for line in installed.splitlines() if ' = ' in line)
+        new = dict(line.split(' = ', 1) for line in rendered.splitlines() if ' = ' in line)
+        restart = [name for name in restart_only if old.get(name) != new.get(name)]
+        tests = []
+        if map(int, versions[-1].split('.')) >= [9, 2]:
+            tests.append('sudo -u postgres /usr/lib/postgresql/%s/bin/postgres -D %s -C shared_buffers > /dev/null'
+                         % (versions[-1], config_dir))
+        if restart:
+            tests.append('service postgresql restart')
+        if tests:
+            check_config(' && '.join(tests), changed, restart and 'service postgresql restart')
+        else:
+            sudo('rm -f %s.previous' % tuning_path)
+        if not restart:
+            notify_service('postgresql')
+
+def backup_postgresql_config(): 
+    """
+    Backs up the PostgreSQL config to the backup directory
+    """
+    if not backup_exists('postgresql'):
+        backup_dir('/etc', 'postgresql', 'postgresql')
+
+def restore_postgresql_config(): 
+    """
+    Restore original PostgreSQL config from backup if the backup exists
+    """
+    if backup_exists('postgresql'):
+        # remove custom postgresql config
+        sudo('rm -rf /etc/postgresql')
+        restore_dir('/etc', 'postgresql')
+        notify_service('postgresql', 'restart')
 
 def install_nginx_config(): 
     """
     Install nginx conf that will proxy app and app-staging to
-    Apache running on port 9000
+    Apache running on port 9000, or to the app server socket
 
     """
     backup_nginx_config()
     site_avail_file = '/etc/nginx/sites-available/%s' % env.site_name
-    with settings(user='root'):
-        with cd('/etc/nginx'):
-            put(local_path = 'conf/wsgi/nginx/nginx.conf', remote_path='/etc/nginx/nginx.conf')
-            put(local_path='conf/wsgi/nginx/app.example.com', remote_path=site_avail_file)
-    sudo('ln -s /etc/nginx/sites-available/%(site_name)s /etc/nginx/sites-enabled/%(site_name)s' % env)
-    replace_in_file(site_avail_file, 'APP.EXAMPLE.COM', env.site_name)
-    replace_in_file(site_avail_file, 'APP-STAGING.EXAMPLE.COM', env.staging_site_name)
-    replace_in_file(site_avail_file, 'SERVER_IP_ADDRESS', env.server_ip_address)
+    replacements = nginx_profile()
+    replacements.update(nginx_cache())
+    replacements.update({
+        'STATICURL': env.static_url,
+        'BROTLISTATIC': env.static_brotli and 'brotli_static            on;' or '',
+        'DJANGOUPSTREAM': app_server_upstream(env.site_name),
+        'DJANGOSTAGINGUPSTREAM': app_server_upstream(env.staging_site_name),
+        'APP.EXAMPLE.COM': env.site_name,
+        'APP-STAGING.EXAMPLE.COM': env.staging_site_name,
+        'SERVER_IP_ADDRESS': env.server_ip_address,
+    })
+    changed = sync_files([
+        (render_template('conf/wsgi/nginx/nginx.conf', replacements), '/etc/nginx/nginx.conf'),
+        (render_template('conf/wsgi/nginx/django_proxy_params', replacements), '/etc/nginx/django_proxy_params'),
+        (render_template('conf/wsgi/nginx/django_static', replacements), '/etc/nginx/django_static'),
+        (render_template('conf/wsgi/nginx/app.example.com', replacements), site_avail_file),
+    ] + nginx_cache_files(replacements), keep_previous=True)
+    enabled = env.site_name not in facts()['nginx_sites']
+    if enabled:
+        sudo('ln -s /etc/nginx/sites-available/%(site_name)s /etc/nginx/sites-enabled/%(site_name)s' % env)
+        facts()['nginx_sites'].add(env.site_name)
+        # no .previous, so a failed test removes the link again
+        changed.append('/etc/nginx/sites-enabled/%(site_name)s' % env)
+    if changed:
+        check_config(env.service_config_tests['nginx'], changed)
     
     configure_restricted_share('root', env.team_groupname, '/etc/nginx/sites-available')
-    sudo('service nginx restart')
+    if changed:
+        notify_service('nginx')
+
+def nginx_profile():
+    """
+    Helper function.
+    The template values of the selected nginx performance profile
+    """
+    if env.nginx_profile not in env.nginx_profiles:
+        abort("Unknown nginx profile %s, pick one of: %s" % (
+            env.nginx_profile, ', '.join(sorted(env.nginx_profiles))))
+    profile = dict(env.nginx_profiles[env.nginx_profile])
+    profile.update(env.nginx_settings)
+
+    replacements = {
+        'NGINXPROFILE': env.nginx_profile,
+        'NGINXWORKERRLIMITNOFILE': int(profile['worker_connections']) * 2,
+    }
+    for name, value in profile.items():
+        replacements['NGINX' + name.replace('_', '').upper()] = value
+    return replacements
+
+def nginx_cache():
+    """
+    Helper function.
+    The template values for nginx micro-caching, see env.nginx_microcache
+
+    Each prefix in microcache_locations gets its own location that
+    proxies to Django with its own cache time; everything else is cached
+    for microcache_ttl. Production and staging each get their locations,
+    proxying to their own upstream and cache zone, see microcache_zones().
+    """
+    if not env.nginx_microcache:
+        return {'CACHEVALID': ''}
+
+    valid = 'proxy_cache_valid  200 301 302 %s;'
+    replacements = {
+        'CACHEVALID': valid % env.microcache_ttl,
+        'CACHESIZE': env.microcache_size,
+        'CACHEBYPASSCOOKIES': '\n'.join(['    ~*%s= 1;' % cookie for cookie in env.microcache_bypass_cookies]),
+    }
+    for site, zone, cache_dir, suffix in microcache_zones():
+        locations = []
+        for index, prefix in enumerate(sorted(env.microcache_locations)):
+            locations.append('\n'.join([
+                'location ^~ %s {' % prefix,
+                '    try_files $uri @django_cache_%d;' % index,
+                '}',
+                'location @django_cache_%d {' % index,
+                '    proxy_pass         http://%s;' % zone,
+                '    proxy_redirect     off;',
+                '    proxy_set_header   Host             $host;',
+                '    proxy_set_header   X-Real-IP        $remote_addr;',
+                '    proxy_set_header   X-Forwarded-For  $proxy_add_x_forwarded_for;',
+                '    include            django_proxy_params;',
+                '    include            django_cache_params%s;' % suffix,
+                '    ' + valid % env.microcache_locations[prefix],
+                '}',
+            ]))
+        key = suffix.strip('_').upper()
+        replacements['CACHE%sLOCATIONS' % key] = '\n'.join(locations) + '\n'
+        replacements['CACHE%sDIR' % key] = cache_dir
+    return replacements
+
+def microcache_zones():
+    """
+    Helper function.
+    The (site, zone, cache dir, include suffix) of the production and
+    staging server blocks
+
+    The zone names both the nginx upstream and the cache zone of a server
+    block, so staging never reads production's cached responses. Its
+    locations and cache params are in includes ending in the suffix.
+    """
+    return [
+        (env.site_name, 'django', env.microcache_dir, ''),
+        (env.staging_site_name, 'django_staging', env.microcache_dir + '-staging', '_staging'),
+    ]
+
+def nginx_cache_files(replacements):
+    """
+    Helper function.
+    The (local, remote) micro-caching files for sync_files()
+
+    With caching off the includes are uploaded as empty stubs so the
+    site config reads the same either way.
+    """
+    remote = ['/etc/nginx/conf.d/django_cache.conf']
+    for site, zone, cache_dir, suffix in microcache_zones():
+        remote.append('/etc/nginx/django_cache_params' + suffix)
+        remote.append('/etc/nginx/django_cache_locations' + suffix)
+    if not env.nginx_microcache:
+        stub = render_template('conf/wsgi/nginx/django_cache_off', {})
+        return [(stub, path) for path in remote]
+
+    files = [(render_template('conf/wsgi/nginx/django_cache.conf', replacements), remote[0])]
+    for site, zone, cache_dir, suffix in microcache_zones():
+        sudo('mkdir -p %s && chown %s %s' % (cache_dir, env.server_groupname, cache_dir))
+        zone_replacements = dict(replacements, CACHEZONE=zone,
+                                 CACHELOCATIONS=replacements['CACHE%sLOCATIONS' % suffix.strip('_').upper()])
+        files.append((render_template('conf/wsgi/nginx/django_cache_params', zone_replacements),
+                      '/etc/nginx/django_cache_params' + suffix))
+        files.append((render_template('conf/wsgi/nginx/django_cache_locations', zone_replacements),
+                      '/etc/nginx/django_cache_locations' + suffix))
+    return files
+
+def purge_cache(path=None):
+    """
+    Drop the micro-cached copies of a path, or the whole cache
+
+    ``fab production purge_cache:/surveys/`` removes the cached response
+    for that path on the site and the staging site, over http and https.
+    """
+    zones = microcache_zones()
+    if path is None:
+        sudo('find %s -type f -delete' % ' '.join(zone[2] for zone in zones))
+        return
+    files = []
+    for site, zone, cache_dir, suffix in zones:
+        for scheme in ('http', 'https'):
+            key = hashlib.md5(scheme + site + path).hexdigest()
+            files.append('%s/%s/%s/%s' % (cache_dir, key[-1], key[-3:-1], key))
+    sudo('rm -f %s' % ' '.join(files))
 
 def upload_website_apache_localhost(): 
     """
@@ -712,21 +1832,42 @@ def upload_website_apache_localhost():
     which has a call to ``phpinfo()`` and a default index file
     so you can see that the server is working.
     """
-    env.host_string = host
-
-    run('mkdir -p '+webroot_dir+'/apache/localhost')
-    put(local_tar_dir+'/apache/localhost/public.tar.gz', webroot_dir+'/apache/localhost')
-    with cd(webroot_dir+'/apache/localhost'):
-        run('tar -zxf public.tar.gz')
-        run('rm -rf public.tar.gz')
+    stream_tree('%(local_config_dir)s/apache/localhost/public' % env,
+                '%(webroot_dir)s/apache/localhost/public' % env, use_sudo=True)
+    configure_open_share(env.deploy_username, env.server_groupname, env.webroot_dir)
 
 # apt-get
+def aptget_server_packages(update=True): 
+    """
+    Install everything setup_server needs from apt in one transaction
+
+    Runs the aptget_* tasks inside apt_transaction() so there is a single
+    index refresh and a single apt-get install for all of their packages.
+    """
+    with apt_transaction():
+        if update:
+            aptget_software_updates()
+        aptget_misc_deps()
+        aptget_compiler()
+        aptget_common_dev_headers()
+        aptget_git()
+        if env.app_server == 'apache':
+            aptget_apache()
+        else:
+            aptget_install('supervisor')
+        aptget_nginx()
+        aptget_install('openssl')
+
+
 def aptget_software_updates(): 
     """
     Download and install the latest security patches for Ubuntu.
     """
-    sudo('apt-get update')
-    sudo('yes | apt-get upgrade')
+    if env.apt_transaction is not None:
+        env.apt_transaction['upgrade'] = True
+        return
+    aptget_update()
+    sudo('DEBIAN_FRONTEND=noninteractive apt-get -y -q upgrade')
 
 
 def aptget_compiler(): 
@@ -734,7 +1875,7 @@ def aptget_compiler():
     We'll need a compiler and basic build tools if we want
     to compile software.
     """
-    sudo('yes | apt-get install build-essential gcc g++ make')
+    aptget_install('build-essential gcc g++ make')
 
 
 def aptget_common_dev_headers(): 
@@ -742,27 +1883,33 @@ def aptget_common_dev_headers():
     Install database, image and xml dev headers for compiling modules
 
     """
-    sudo('yes | apt-get install libmysqlclient-dev libpq-dev libmagickwand-dev libxml2-dev libxslt1-dev python-dev libcurl4-openssl-dev')
+    aptget_install('libmysqlclient-dev libpq-dev libmagickwand-dev libxml2-dev libxslt1-dev python-dev libcurl4-openssl-dev')
 
 
 def aptget_databases(): 
     """
     Install the common databases: MySQL, Postgres and SQLite
     """
-    sudo('yes | apt-get install mysql-server mysql-client postgresql sqlite sqlite3')
+    aptget_install('mysql-server mysql-client postgresql sqlite sqlite3')
 
 
+def aptget_pgbouncer(): 
+    """
+    Install the PgBouncer connection pooler
+    """
+    aptget_install('pgbouncer')
+
 def aptget_apache(): 
     """
     Install Apache along with wsgi
     """
-    sudo('yes | apt-get install apache2 apache2-dev libapache2-mod-wsgi')
+    aptget_install('apache2 apache2-dev libapache2-mod-wsgi')
 
 def aptget_git():
    """
    Install git
    """
-   sudo('yes | apt-get install git')
+   aptget_install('git')
     
 
 def a2enmod_rewrite(): 
@@ -770,7 +1917,7 @@ def a2enmod_rewrite():
     Enable the Rewrite module
     """
     sudo('a2enmod rewrite')
-    restart_apache()
+    notify_service('apache2')
 
 
 def a2enmod_proxy(): 
@@ -779,7 +1926,7 @@ def a2enmod_proxy():
     """
     sudo('a2enmod proxy')
     sudo('a2enmod proxy_http')
-    restart_apache()
+    notify_service('apache2')
 
 
 def a2enmod_wsgi(): 
@@ -787,20 +1934,20 @@ def a2enmod_wsgi():
     Install and enable the apache WSGI module for running python apps
     """
     sudo('a2enmod wsgi')
-    restart_apache()
+    notify_service('apache2')
 
 
 def aptget_nginx(): 
     """
     Update to the lates nginx repo and install nginx
     """
-    sudo('yes | apt-get install nginx-common nginx-extras')
+    aptget_install('nginx-common nginx-extras')
 
 def aptget_mail_server(): 
     """
     Install the commonly desired tools for setting up a mail server
     """
-    sudo('yes | apt-get install dovecot-postfix postfix-doc postfix-mysql')
+    aptget_install('dovecot-postfix postfix-doc postfix-mysql')
 
 
 def aptget_vim(): 
@@ -811,7 +1958,7 @@ def aptget_vim():
     * ``ctags`` exuberrant ctags
     * ``par`` the paragraph formatter
     """
-    sudo('yes | apt-get install vim ctags par')
+    aptget_install('vim ctags par')
 
 
 def aptget_misc_deps(): 
@@ -827,8 +1974,7 @@ def aptget_misc_deps():
     like gnome-256color so that we can still SSH from gnome-terminal
     with a proper terminfo value and things don't get wonky
     """
-    sudo('apt-get update')
-    sudo('yes | apt-get install python-software-properties mlocate tmux ncurses-term curl')
+    aptget_install('python-software-properties mlocate tmux ncurses-term curl rsync pigz')
 
 # python
 def install_python_distribute(): 
@@ -838,6 +1984,8 @@ def install_python_distribute():
     Install setuptools so we can build pip and other packages.
     I prefer using distribute.
     """
+    if remote_exists('/usr/local/bin/easy_install'):
+        return
     sudo('curl -O http://python-distribute.org/distribute_setup.py')
     sudo('python distribute_setup.py')
 
@@ -846,6 +1994,8 @@ def install_python_pip():
     """
     Download and install a recent version of the pip utility
     """
+    if remote_exists('/usr/local/bin/pip'):
+        return
     the_file = env.pip_vers + '.tar.gz'
     sudo('wget %s' % env.pip_url)
 
@@ -862,6 +2012,8 @@ def install_python_pip():
 
 
 def install_python_virtualenv(): 
+    if remote_exists('/usr/local/bin/virtualenvwrapper.sh'):
+        return
     sudo('pip install virtualenv virtualenvwrapper')
 
 def setup_webapps_location(): 
@@ -872,11 +2024,14 @@ def configure_python_virtualenv():
     """
     Add virtualenv capabilites to this user.
     """
-    run("mkdir -p %(virtual_environments_location)s" % env)
-    run("echo >> ~/.bashrc")
-    run("echo 'export WORKON_HOME=%(virtual_environments_location)s' >> ~/.bashrc" % env)
-    run("echo 'export VIRTUALENV_USE_DISTRIBUTE=1' >> ~/.bashrc")
-    run("echo 'source /usr/local/bin/virtualenvwrapper.sh' >> ~/.bashrc")
+    with command_batch() as batch:
+        batch.append("mkdir -p %(virtual_environments_location)s" % env)
+        # only once, setup_server may run again
+        batch.append("if ! grep -q virtualenvwrapper.sh ~/.bashrc; then "
+                     "echo >> ~/.bashrc; "
+                     "echo 'export WORKON_HOME=%(virtual_environments_location)s' >> ~/.bashrc; "
+                     "echo 'export VIRTUALENV_USE_DISTRIBUTE=1' >> ~/.bashrc; "
+                     "echo 'source /usr/local/bin/virtualenvwrapper.sh' >> ~/.bashrc; fi" % env)
 
 # SUPPORT TASKS
 ################################################################
@@ -928,6 +2083,146 @@ def regen_tarballs():
         regen_tarball(source=config['source'], srcdir=config['srcdir'])
 
 
+def profile():
+    """
+    Time every task and remote call of this fab run and report at the end
+
+    Use it like an environment, before the tasks to measure::
+
+        fab profile production setup_server
+
+    Every task in this fabfile plus run, sudo, put, get, local and
+    sshagent_run record their wall time, bytes moved and exit code. When
+    fab exits a per-host tree and a per-task summary are printed and the
+    same data is saved as JSON in env.profile_report_dir, so runs can be
+    compared between releases.
+    """
+    if env.profile:
+        return
+    env.profile = True
+
+    from fabric import state
+    module = globals()
+    for name in ['run', 'sudo', 'put', 'get', 'local']:
+        module[name] = profiled(module[name], name)
+    for name, func in module.items():
+        if (not hasattr(func, 'func_code') or name in env.profile_skip
+            or func.__module__ != __name__):
+            continue
+        kind = name == 'sshagent_run' and 'sshagent_run' or 'task'
+        module[name] = profiled(func, kind)
+        if state.commands.get(name) is func:
+            state.commands[name] = module[name]
+    atexit.register(profile_report)
+
+def profiled(func, kind):
+    """
+    Wrap a task or operation so each call adds a node to the timing tree
+    """
+    @functools.wraps(func)
+    def timed(*args, **kwargs):
+        node = {
+            'name': func.__name__,
+            'kind': kind,
+            'host': env.host_string,
+            'command': kind != 'task' and args and str(args[0]) or None,
+            'seconds': 0.0,
+            'bytes': 0,
+            'exit_code': None,
+            'children': [],
+        }
+        if env.profile_stack:
+            env.profile_stack[-1]['children'].append(node)
+        else:
+            env.profile_roots.append(node)
+        env.profile_stack.append(node)
+        start = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except SystemExit:
+            node['exit_code'] = 'aborted'
+            raise
+        finally:
+            node['seconds'] = time.time() - start
+            env.profile_stack.pop()
+        if kind != 'task':
+            node['bytes'] = profile_bytes(kind, args, kwargs, result)
+            if hasattr(result, 'return_code'):
+                node['exit_code'] = result.return_code
+            elif hasattr(result, 'failed'):
+                node['exit_code'] = result.failed and 1 or 0
+        return result
+    return timed
+
+def profile_bytes(kind, args, kwargs, result):
+    """
+    Bytes an operation moved: output for commands, file sizes for transfers
+    """
+    if kind == 'put':
+        local_path = kwargs.get('local_path', args and args[0])
+        if hasattr(local_path, 'getvalue'):
+            return len(local_path.getvalue())
+        paths = glob.glob(os.path.expanduser(str(local_path)))
+        size = 0
+        for path in paths:
+            if os.path.isdir(path):
+                for dirpath, dirnames, filenames in os.walk(path):
+                    size += sum(os.path.getsize(os.path.join(dirpath, f)) for f in filenames)
+            elif os.path.isfile(path):
+                size += os.path.getsize(path)
+        return size
+    if kind == 'get':
+        return sum(os.path.getsize(path) for path in result or [] if os.path.isfile(path))
+    return len(result or '')
+
+def profile_report():
+    """
+    Print the timing tree and per-task totals, and save them as JSON
+    """
+    if not env.profile_roots:
+        return
+
+    def walk(nodes, depth, lines, totals):
+        for node in nodes:
+            label = node['kind'] == 'task' and node['name'] or '%s: %s' % (
+                node['kind'], node['command'][:60])
+            extra = ''
+            if node['kind'] != 'task':
+                extra = ' %10d bytes  exit %s' % (node['bytes'], node['exit_code'])
+            lines.append('%8.2fs  [%s] %-72s%s' % (node['seconds'], node['host'] or 'local',
+                '  ' * depth + label, extra))
+            if node['kind'] == 'task':
+                key = (node['host'] or 'local', node['name'])
+                totals[key] = totals.get(key, 0.0) + node['seconds']
+            walk(node['children'], depth + 1, lines, totals)
+
+    lines, totals = [], {}
+    walk(env.profile_roots, 0, lines, totals)
+    summary = sorted(totals.items(), key=lambda item: -item[1])
+
+    print
+    print 'Timing report'
+    print '============='
+    for line in lines:
+        print line
+    print
+    print 'Time per task and host (nested tasks are counted in their parents too)'
+    for (host, name), seconds in summary:
+        print '%8.2fs  [%s] %s' % (seconds, host, name)
+
+    if not os.path.isdir(env.profile_report_dir):
+        os.makedirs(env.profile_report_dir)
+    report_path = os.path.join(env.profile_report_dir, time.strftime('%Y-%m-%d_%H%M%S.json'))
+    report = open(report_path, 'w')
+    json.dump({
+        'tree': env.profile_roots,
+        'totals': [{'host': host, 'task': name, 'seconds': seconds}
+                   for (host, name), seconds in summary],
+    }, report, indent=2)
+    report.close()
+    print
+    print 'Saved to %s' % report_path
+
 def docs(): 
     """
     Regenerate the sphinx based documentation for this fabfile
@@ -1000,6 +2295,229 @@ def clean_remote_backup_dir():
     run('if [ -e '+remote_backup_dir+' ]; then rm -rf '+remote_backup_dir+'; fi')
 
 
+# Remote facts
+def gather_facts():
+    """
+    Collect the remote state the install tasks check before doing any work
+
+    One remote call lists installed packages, users, groups and their
+    members, enabled apache and nginx sites, which of the paths from
+    fact_paths() exist and the md5 of the files from fact_files(), along
+    with the memory, cores, disk type and PostgreSQL and mod_wsgi
+    versions. The result is cached in env.facts for the current host,
+    see facts().
+    """
+    sections = [
+        ('packages', "dpkg-query -W -f='${Status} ${Package}\\n' | awk '$3 == \"installed\" {print $4}'"),
+        ('users', 'getent passwd | cut -d: -f1'),
+        ('groups', 'getent group | cut -d: -f1,4'),
+        ('apache_sites', 'ls /etc/apache2/sites-enabled'),
+        ('nginx_sites', 'ls /etc/nginx/sites-enabled'),
+        ('paths', 'for p in %s; do [ -e "$p" ] && echo "$p"; done' % ' '.join(fact_paths())),
+        ('checksums', 'md5sum %s' % ' '.join(fact_files())),
+        ('memory', "awk '/^MemTotal:/ {print $2}' /proc/meminfo"),
+        ('cores', 'nproc'),
+        ('rotational', 'cat /sys/block/[hsvx]d*/queue/rotational'),
+        ('postgresql', 'ls /etc/postgresql'),
+        ('mod_wsgi', "dpkg-query -W -f='${Version}\\n' libapache2-mod-wsgi"),
+    ]
+    script = '; '.join(["echo '::facts:: %s'; { %s; } 2>/dev/null" % section for section in sections])
+    with settings(hide('running', 'stdout'), warn_only=True):
+        output = sudo(script)
+
+    found = dict((name, []) for name, cmd in sections)
+    lines = found['packages']
+    for line in output.splitlines():
+        line = line.strip()
+        if line.startswith('::facts:: '):
+            lines = found[line.split()[1]]
+        elif line:
+            lines.append(line)
+
+    groups = {}
+    for line in found['groups']:
+        name, members = (line + ':').split(':')[:2]
+        groups[name] = set(filter(None, members.split(',')))
+    checksums = {}
+    for line in found['checksums']:
+        md5, path = line.split(None, 1)
+        checksums[path] = md5
+    mod_wsgi = re.match(r'(?:\d+:)?(\d+)\.(\d+)', ''.join(found['mod_wsgi'][:1]))
+
+    env.facts[env.host_string] = {
+        'packages': set(found['packages']),
+        'users': set(found['users']),
+        'groups': groups,
+        'apache_sites': set(found['apache_sites']),
+        'nginx_sites': set(found['nginx_sites']),
+        'paths': set(found['paths']),
+        'checksums': checksums,
+        'memory_mb': int((found['memory'] or [0])[0]) / 1024,
+        'cores': int((found['cores'] or [1])[0]),
+        'ssd': '1' not in found['rotational'],
+        'postgresql_versions': sorted(found['postgresql'], key=lambda v: map(int, v.split('.'))),
+        'mod_wsgi_version': mod_wsgi and map(int, mod_wsgi.groups()),
+    }
+    return env.facts[env.host_string]
+
+def facts():
+    """
+    Return the cached facts for the current host, gathering them on first use
+    """
+    if env.host_string not in env.facts:
+        gather_facts()
+    return env.facts[env.host_string]
+
+def forget_facts():
+    """
+    Drop the cached facts for the current host
+    """
+    env.facts.pop(env.host_string, None)
+
+def fact_paths():
+    """
+    Paths whose existence tells an install task its work is already done
+    """
+    paths = [
+        '/usr/local/bin/easy_install',
+        '/usr/local/bin/pip',
+        '/usr/local/bin/virtualenvwrapper.sh',
+        '%(webapps_location)s/ssl/nginx.pem' % env,
+    ]
+    for name in env.virtual_environments:
+        env_path = env.webapps_location + '/' + name
+        paths.append(env_path + '/bin/activate')
+        paths.append(env_path + '/' + env.appname + '/.git')
+        paths.append(env_path + '/' + env.appname + '/keys')
+        if env.app_server != 'apache':
+            paths.append(env_path + '/current/bin/' + env.app_server)
+    return paths
+
+def fact_files():
+    """
+    Files whose checksum tells an install task its work is already done
+    """
+    return [
+        '/etc/sudoers.d/%(main_username)s' % env,
+        '/etc/sudoers.d/%(team_groupname)s' % env,
+    ]
+
+def remote_exists(path):
+    """
+    Check the cached facts for a path collected by fact_paths()
+
+    Paths not in fact_paths() are tested with a remote call of their own.
+    """
+    if path in facts()['paths']:
+        return True
+    if path in fact_paths():
+        return False
+    with settings(hide('running', 'warnings'), warn_only=True):
+        exists = sudo('[ -e %s ]' % path).succeeded
+    if exists:
+        facts()['paths'].add(path)
+    return exists
+
+def remote_md5(path):
+    """
+    Return the cached md5 of a remote file collected by fact_files(), or None
+    """
+    return facts()['checksums'].get(path)
+
+def aptget_install(packages):
+    """
+    Install the given apt packages, skipping any that are already installed
+
+    Inside apt_transaction() the packages are only collected and get
+    installed together when the transaction ends.
+    """
+    missing = [name for name in packages.split() if name not in facts()['packages']]
+    if env.apt_transaction is not None:
+        env.apt_transaction['packages'].extend(missing)
+    elif missing:
+        aptget_update()
+        push_apt_cache()
+        sudo('DEBIAN_FRONTEND=noninteractive apt-get -y -q install %s' % ' '.join(missing))
+        facts()['packages'].update(missing)
+
+@contextlib.contextmanager
+def apt_transaction():
+    """
+    Collect the packages of every aptget_* task run inside and install them at once
+
+    Usage::
+
+        with apt_transaction():
+            aptget_compiler()
+            aptget_git()
+
+    On the way out the index is refreshed once, the system is upgraded if
+    aptget_software_updates() asked for it, and all missing packages go
+    into a single non-interactive apt-get install.
+    """
+    if env.apt_transaction is not None:
+        # already collecting, the outer transaction installs
+        yield
+        return
+    env.apt_transaction = {'packages': [], 'upgrade': False}
+    try:
+        yield
+        transaction = env.apt_transaction
+    finally:
+        env.apt_transaction = None
+
+    packages = []
+    for name in transaction['packages']:
+        if name not in packages:
+            packages.append(name)
+    if not packages and not transaction['upgrade']:
+        return
+
+    aptget_update()
+    push_apt_cache()
+    with command_batch(use_sudo=True) as batch:
+        if transaction['upgrade']:
+            batch.append('DEBIAN_FRONTEND=noninteractive apt-get -y -q upgrade')
+        if packages:
+            batch.append('DEBIAN_FRONTEND=noninteractive apt-get -y -q install %s' % ' '.join(packages))
+    facts()['packages'].update(packages)
+
+def aptget_update():
+    """
+    Refresh the apt package index, at most once per host and fab run
+    """
+    if not facts().get('apt_updated'):
+        sudo('apt-get -q update')
+        facts()['apt_updated'] = True
+
+def push_apt_cache():
+    """
+    Upload the .deb files from env.local_apt_cache_dir into the host's apt cache
+
+    apt uses any cached .deb that matches the version it wants instead of
+    downloading it again, so a primed local cache keeps fleet bootstraps
+    off the mirrors. Does nothing if the local cache is empty.
+    """
+    if facts().get('apt_cache_pushed'):
+        return
+    facts()['apt_cache_pushed'] = True
+    if not os.path.isdir(env.local_apt_cache_dir):
+        return
+    if not [f for f in os.listdir(env.local_apt_cache_dir) if f.endswith('.deb')]:
+        return
+    with settings(user='root'):
+        put('%(local_apt_cache_dir)s/*.deb' % env, '/var/cache/apt/archives/')
+
+def fetch_apt_cache():
+    """
+    Download the host's cached .deb files into env.local_apt_cache_dir
+
+    Run this against a freshly bootstrapped host to prime the cache
+    push_apt_cache() uploads to the rest of the fleet.
+    """
+    local('mkdir -p %(local_apt_cache_dir)s' % env)
+    get('/var/cache/apt/archives/*.deb', env.local_apt_cache_dir)
+
 # User and Permissions Helpers
 def configure_restricted_share(user, group, directory): 
     """
@@ -1025,9 +2543,10 @@ def clone_root_pubkey(user, home):
     Copy our current key from the root user to another user to
     avoid the need for a password when logging in.
     """
-    run('mkdir -p '+home+'/.ssh')
-    run('cp /root/.ssh/authorized_keys '+home+'/.ssh/authorized_keys')
-    run('chown -R '+user+'.'+user+' '+home+'/.ssh')
+    with command_batch() as batch:
+        batch.append('mkdir -p '+home+'/.ssh')
+        batch.append('cp /root/.ssh/authorized_keys '+home+'/.ssh/authorized_keys')
+        batch.append('chown -R '+user+'.'+user+' '+home+'/.ssh')
 
 def add_custom_user(user, password, fancy=True): 
     """
@@ -1036,43 +2555,48 @@ def add_custom_user(user, password, fancy=True):
     Add a user account with a skeleton directory structure
     from the config in the local skel dir
     """
+    if user in facts()['users']:
+        return
     with settings(custom_user=user, custom_password=password):
-        sudo('useradd --skel %(remote_config_dir)s/skel --create-home --home-dir /home/%(custom_user)s --shell /bin/bash %(custom_user)s' % env)
-        sudo('yes "%(custom_password)s" | passwd %(custom_user)s' % env)
+        with command_batch(use_sudo=True) as batch:
+            batch.append('useradd --skel %(remote_config_dir)s/skel --create-home --home-dir /home/%(custom_user)s --shell /bin/bash %(custom_user)s' % env)
+            batch.append('yes "%(custom_password)s" | passwd %(custom_user)s' % env)
+    facts()['users'].add(user)
+
+def shell_quote(value):
+    """
+    Quote a value so the remote shell passes it through untouched
+    """
+    return "'%s'" % value.replace("'", "'\\''")
+
+def add_user_to_group(user, group):
+    """
+    Add a user to a group unless they are already a member
+    """
+    if user not in facts()['groups'].get(group, ()):
+        sudo('adduser %s %s' % (user, group))
+        facts()['groups'].setdefault(group, set()).add(user)
 
 def backup_user_home(user): 
     """
     Backup a users home dir to the backup dir
 
-    If no backup yet exists for the given user's home directory
-    then create a backup for that user in remote_backup_dir/home_user.tar.gz
+    Takes an incremental snapshot of the given user's home directory
+    in remote_snapshot_dir/home_user, see take_snapshot()
     """
-    env.host_string = root_host
-
-    bak_file = remote_backup_dir+'/home_'+user+'.tar.gz'
     with settings(hide('warnings'), warn_only=True):
-        if run('[ ! -e '+bak_file+' ]').succeeded:
-            if run('[ -e /home/'+user+' ]').succeeded:
-                with cd('/home'):
-                    run('tar -czf '+bak_file+' '+user)
+        if sudo('[ -e /home/'+user+' ]').succeeded:
+            take_snapshot('home_'+user, '/home/'+user)
 
 
-def restore_user_home(user): 
+def restore_user_home(user, stamp='latest'): 
     """
-    Restore a user's original home directory from the backup dir
+    Restore a user's home directory from a snapshot
 
-    If a backup exists for the user's home directory, delete the
-    current home directory and restore from the backup.
+    Brings the home directory back to the given snapshot, the latest one
+    by default. Use list_snapshots:home_<user> to see what is kept.
     """
-    env.host_string = root_host
-
-    bak_file = remote_backup_dir+'/home_'+user+'.tar.gz'
-    with settings(hide('warnings'), warn_only=True):
-        if run('[ -e '+bak_file+' ]').succeeded:
-            if run('[ -e /home/'+user+' ]').succeeded:
-                with cd('/home'):
-                    run('rm -rf '+user)
-                    run('tar -xzf '+bak_file)
+    restore_snapshot('home_'+user, '/home/'+user, stamp)
 
 
 def reskel_existing_user(user, home=''): 
@@ -1082,8 +2606,6 @@ def reskel_existing_user(user, home=''):
     Backup the user's home directory and install
     fresh files from the custom skeleton instead
     """
-    env.host_string = root_host
-
     if not len(home):
         home = '/home/'+user
 
@@ -1091,14 +2613,10 @@ def reskel_existing_user(user, home=''):
 
     # may want to add an option to override this
     # so hydration is non destructive
-    run('rm -rf '+home)
-    run('mkdir '+home)
-
-    filenames = local('find skel -type f', capture=True).split('\n')
-    for f in filenames:
-        put(f, home)
-
-    run('chown -R '+user+'.'+user+' '+home)
+    with settings(user='root'):
+        run('rm -rf '+home)
+        stream_tree('%(local_config_dir)s/skel' % env, home)
+        run('chown -R '+user+'.'+user+' '+home)
 
 
 
@@ -1113,14 +2631,16 @@ def set_fqdn():
     sudo("hostname %(server_hostname)s" % env)
 
 def setup_ssl_cert():
-    sudo("apt-get install openssl")
+    aptget_install('openssl')
+    if remote_exists('%(webapps_location)s/ssl/nginx.pem' % env):
+        return
     with cd(env.webapps_location):
-        sudo("mkdir ssl")
-        with settings(user='root'):
-            put(local_path="conf/ssl/sslcert.conf", remote_path="%(webapps_location)s/ssl" % env)
-        replace_in_file('ssl/sslcert.conf', 'Example, Inc.', env.ssl_organization_name)
-        replace_in_file('ssl/sslcert.conf', 'server.example.com', env.hostname)
-        replace_in_file('ssl/sslcert.conf', 'postmaster@example.com', env.ssl_contact)
+        sudo("mkdir -p ssl")
+        upload_template('conf/ssl/sslcert.conf', '%(webapps_location)s/ssl/sslcert.conf' % env, {
+            'Example, Inc.': env.ssl_organization_name,
+            'server.example.com': env.hostname,
+            'postmaster@example.com': env.ssl_contact,
+        })
         sudo("openssl req -new -x509 -days 365 -nodes -config ssl/sslcert.conf -out ssl/nginx.pem -keyout ssl/nginx.key")
         sudo("chmod 600 ssl/*")
 
@@ -1128,29 +2648,227 @@ def clean_ssl():
     env.host_string = root_host
     run("rm -rf %s/ssl" % webapps_location )
 
+def check_config(config_test, changed, recover=None):
+    """
+    Helper function.
+    Run a config test on files just uploaded by sync_files(keep_previous=True)
+
+    If the test fails every changed file is put back the way it was
+    before aborting, so a bad template never stays on the server, and
+    the recover command is run on the old files. If it passes the
+    .previous copies are deleted.
+    """
+    with settings(hide('warnings'), warn_only=True):
+        result = sudo(config_test)
+    if result.failed:
+        with command_batch(use_sudo=True) as batch:
+            for path in changed:
+                batch.append('if [ -e %s.previous ]; then mv -f %s.previous %s; else rm -f %s; fi' % (
+                    path, path, path, path))
+            if recover:
+                batch.append(recover)
+        abort("%s failed, the previous config was put back:\n%s" % (config_test, result))
+    sudo('rm -f %s' % ' '.join(path + '.previous' for path in changed))
+
+def stream_command(command, transfer, description, use_sudo=False):
+    """
+    Helper function.
+    Run a remote command on its own ssh channel and return its exit status
+
+    transfer(channel) feeds the command or reads its output while it runs;
+    pipes fail as a whole. On a non-zero status description and the
+    remote stderr are passed to warn() or abort(), as with warn_only. The
+    channel is closed either way.
+    """
+    command = 'bash -c %s' % shell_quote('set -o pipefail; ' + command)
+    if use_sudo:
+        command = 'sudo -n ' + command
+
+    channel = connections[env.host_string].get_transport().open_session()
+    try:
+        channel.exec_command(command)
+        transfer(channel)
+        status = channel.recv_exit_status()
+        if status != 0:
+            errors = channel.makefile_stderr('rb').read()
+    finally:
+        channel.close()
+
+    if status != 0:
+        msg = "%s failed with exit code %d:\n%s" % (description, status, errors)
+        if env.warn_only:
+            warn(msg)
+        else:
+            abort(msg)
+    return status
+
+def stream_tree(local_dir, remote_dir, use_sudo=False):
+    """
+    Copy a local directory tree into remote_dir as one streamed tar archive
+
+    The archive is built in memory while it is written into a remote
+    ``tar -x`` over a single ssh channel, so there are no temp files on
+    either side and no per-file transfers. Existing files in remote_dir
+    are overwritten, others are left alone. Extracted files belong to the
+    remote user; chown afterwards if they need another owner.
+    """
+    def send(channel):
+        stream = channel.makefile('wb')
+        archive = tarfile.open(fileobj=stream, mode='w|gz')
+        archive.add(local_dir, arcname='.')
+        archive.close()
+        stream.close()
+        channel.shutdown_write()
+
+    return stream_command('mkdir -p %s && tar -xzf - --no-same-owner -C %s' % (remote_dir, remote_dir),
+                          send, "streaming %s to %s" % (local_dir, remote_dir), use_sudo)
+
+def fetch_stream(command, local_path, use_sudo=False):
+    """
+    Run a remote command and write its output into local_path
+
+    The reverse of stream_tree(): the output comes back over a single ssh
+    channel straight into the local file, so nothing is written to the
+    remote disk. local_path only appears once the command has succeeded.
+    """
+    part_path = local_path + '.part'
+    def receive(channel):
+        with open(part_path, 'wb') as output:
+            shutil.copyfileobj(channel.makefile('rb'), output, 1024 * 1024)
+
+    try:
+        status = stream_command(command, receive, "fetching %s" % local_path, use_sudo)
+        if status == 0:
+            os.rename(part_path, local_path)
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+    return status
+
+def send_stream(local_path, command, use_sudo=False):
+    """
+    Feed a local file into a remote command over a single ssh channel
+    """
+    def send(channel):
+        stream = channel.makefile('wb')
+        with open(local_path, 'rb') as source:
+            shutil.copyfileobj(source, stream, 1024 * 1024)
+        stream.close()
+        channel.shutdown_write()
+
+    return stream_command(command, send, "sending %s" % local_path, use_sudo)
+
 def replace_in_file(remote_file_path, target, replacement):
+    """
+    Replace a literal string in a remote file with sed
+
+    For files that only exist on the server. Files made from templates in
+    conf/ should go through upload_template() instead.
+    """
+    target = re.sub(r'([][\\/.*^$])', r'\\\1', target)
+    replacement = re.sub(r'([\\/&])', r'\\\1', replacement)
     sudo("sed -i 's/%s/%s/g' %s" % (target, replacement, remote_file_path))
+
+def render_template(template_path, replacements):
+    """
+    Render a conf/ template locally and return the path of the result
+
+    Every placeholder key of ``replacements`` is swapped for its value in
+    a single pass, so values are never matched again and need no escaping.
+    The output is kept in env.local_render_dir under the md5 of its
+    content and reused if it is already there.
+    """
+    template = open(template_path).read()
+    if replacements:
+        placeholders = sorted(replacements, key=len, reverse=True)
+        pattern = re.compile('|'.join(re.escape(p) for p in placeholders))
+        rendered = pattern.sub(lambda match: str(replacements[match.group(0)]), template)
+    else:
+        rendered = template
+
+    rendered_path = os.path.join(env.local_render_dir, hashlib.md5(rendered).hexdigest())
+    if not os.path.exists(rendered_path):
+        if not os.path.isdir(env.local_render_dir):
+            os.makedirs(env.local_render_dir)
+        partial = '%s.partial-%d' % (rendered_path, os.getpid())
+        out = open(partial, 'w')
+        out.write(rendered)
+        out.close()
+        os.rename(partial, rendered_path)
+    return rendered_path
+
+def upload_template(template_path, remote_path, replacements=None):
+    """
+    Render a conf/ template locally and upload the finished file if it changed
+
+    Returns the list of uploaded paths, empty if the remote file was
+    already up to date, see sync_files().
+    """
+    rendered_path = render_template(template_path, replacements or {})
+    return sync_files([(rendered_path, remote_path)])
+
+def sync_files(files, keep_previous=False):
+    """
+    Upload only the (local_path, remote_path) pairs whose content differs
+
+    The md5 of every remote file is read in one call and compared to the
+    local file; missing or different files are uploaded as root. Returns
+    the remote paths that were uploaded, so an empty list means nothing
+    changed and no reload is needed. With keep_previous the replaced
+    files are saved as <path>.previous for check_config().
+    """
+    files = [(os.path.expanduser(local_path), remote_path) for local_path, remote_path in files]
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        output = sudo('md5sum %s 2>/dev/null' % ' '.join(remote for local_path, remote in files))
+    remote_md5s = {}
+    for line in output.splitlines():
+        if line.strip():
+            md5, path = line.split(None, 1)
+            remote_md5s[path.strip()] = md5
+
+    changed = []
+    for local_path, remote_path in files:
+        local_md5 = hashlib.md5(open(local_path, 'rb').read()).hexdigest()
+        if remote_md5s.get(remote_path) != local_md5:
+            if keep_previous:
+                sudo('rm -f %s.previous; [ ! -e %s ] || cp -p %s %s.previous' % (
+                    remote_path, remote_path, remote_path, remote_path))
+            with settings(user='root'):
+                put(local_path=local_path, remote_path=remote_path)
+            changed.append(remote_path)
+    return changed
     
 def make_virtual_environments(): 
     for virtual_environment_name in env.virtual_environments:
         env_path = make_virtual_environment(virtual_environment_name)
         with cd(env_path):
-            sudo('mkdir logs')
-            sudo('mkdir apache')
+            sudo('mkdir -p logs apache')
         install_wsgi_config(virtual_environment_name, env_path)
         source_path = clone_repo(env_path)
         install_virtual_env_requirements(env_path, source_path)
-        install_django_app_config_file(virtual_environment_name)
+        # the first checkout serves the site until deploy() switches current
+        sudo('[ -e %s/current ] || ln -s %s %s/current' % (env_path, env_path, env_path))
+        config_changed = install_django_app_config_file(virtual_environment_name)
         make_keyczar_keys(virtual_environment_name, env_path)
-        setup_apache_wsgi(virtual_environment_name)
+        if env.app_server == 'apache':
+            setup_apache_wsgi(virtual_environment_name)
+        else:
+            install_app_server(virtual_environment_name, env_path, config_changed)
+    for site in (env.site_name, env.staging_site_name):
+        collect_static(site, env.webapps_location + '/' + site_virtual_environment(site))
     set_user_and_group(env.server_groupname, env.server_groupname, env.webapps_location)
 
 def install_wsgi_config(virtual_environment_name, env_path): 
     wsgi_config_path = env_path + "/apache/django.wsgi-%s" % virtual_environment_name
-    with settings(user='root'):
-        put(local_path="conf/wsgi/django.wsgi", remote_path=wsgi_config_path)
-    replace_in_file(wsgi_config_path, "APP.EXAMPLE.COM", virtual_environment_name)
-    replace_in_file(wsgi_config_path, "APPNAME", env.appname)
+    rendered_path = render_template("conf/wsgi/django.wsgi", {
+        "APP.EXAMPLE.COM": virtual_environment_name,
+        "APPNAME": env.appname,
+    })
+    files = [(rendered_path, wsgi_config_path)]
+    if env.app_server != 'apache':
+        # gunicorn and uwsgi want an importable module
+        files.append((rendered_path, env_path + "/apache/wsgi_app.py"))
+    sync_files(files)
 
 def clean_wsgi_config(env_path):
     sudo ("rm -rf %s/apache" % env_path)
@@ -1161,7 +2879,8 @@ def set_user_and_group(user, group, path):
         
 def make_virtual_environment(virtual_env_base_name):
     virtual_env_path = env.webapps_location + '/' + virtual_env_base_name
-    sudo("virtualenv " + virtual_env_path)
+    if not remote_exists(virtual_env_path + '/bin/activate'):
+        sudo("virtualenv " + virtual_env_path)
     return virtual_env_path
 
 def clean_virtual_environments():
@@ -1174,21 +2893,261 @@ def clean_virtual_environment(virtual_env_base_name):
 
 def clone_repo(virtual_env_path):
     source_path = virtual_env_path + '/' + env.appname
-    sudo("git clone " + env.git_repo + ' ' + source_path)
+    if not remote_exists(source_path + '/.git'):
+        sudo("git clone " + env.git_repo + ' ' + source_path)
     return source_path
     
 def install_virtual_env_requirements(virtual_env_path, source_path):
+    install_requirements(virtual_env_path, source_path, use_sudo=True)
+
+def install_requirements(virtual_env_path, source_path, use_sudo=False):
+    """
+    Install requirements.pip into a virtualenv from prebuilt wheels
+
+    The md5 of requirements.pip picks the wheelhouse; it is built locally
+    by build_wheelhouse() if needed, uploaded once per host and installed
+    with no index access and nothing to compile. The md5 of the last
+    successful install is kept in the virtualenv so unchanged requirements
+    skip the whole step.
+    """
+    remote = use_sudo and sudo or run
     requirements_file_path = source_path + '/requirements.pip'
-    sudo("source  " + virtual_env_path + "/bin/activate; pip install -r " + requirements_file_path)
+    marker_path = virtual_env_path + '/.requirements.md5'
+
+    with settings(hide('running', 'stdout'), warn_only=True):
+        key = remote("md5sum %s | awk '{print $1}'" % requirements_file_path).strip()
+        installed = remote('cat %s 2>/dev/null' % marker_path).strip()
+    if not key:
+        abort("Can't read %s" % requirements_file_path)
+    if key == installed:
+        puts('Requirements unchanged since the last install, skipping.')
+        return
+
+    wheelhouse = build_wheelhouse(requirements_file_path, key)
+    remote_wheelhouse = '%s/%s' % (env.remote_wheelhouse_dir, key)
+    if not remote_exists(remote_wheelhouse):
+        sudo('mkdir -p %(remote_wheelhouse_dir)s' % env)
+        with settings(user='root'):
+            put(wheelhouse, env.remote_wheelhouse_dir)
+
+    ensure_wheel_support(virtual_env_path, remote)
+    remote('source %s/bin/activate; pip install --no-index --find-links=%s -r %s' % (
+        virtual_env_path, remote_wheelhouse, requirements_file_path))
+    remote('echo %s > %s' % (key, marker_path))
+
+def ensure_wheel_support(virtual_env_path, remote=run):
+    """
+    Helper function.
+    Make sure the virtualenv's pip can install wheels (pip 1.4 or later)
+
+    Older pips are upgraded in place, pinned to the last releases that
+    still run on python 2, and the run aborts if that doesn't take.
+    """
+    def pip_version():
+        with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+            output = remote('source %s/bin/activate; pip --version' % virtual_env_path)
+        match = re.search(r'pip (\d+)\.(\d+)', output)
+        return match and (int(match.group(1)), int(match.group(2))) or (0, 0)
+
+    if pip_version() >= (1, 4):
+        return
+    remote('source %s/bin/activate; pip install -U "pip>=1.4,<21" "setuptools>=0.8,<45" "wheel<0.35"' % virtual_env_path)
+    if pip_version() < (1, 4):
+        abort("pip in %s can't install wheels, it needs pip 1.4 or later." % virtual_env_path)
+
+def build_wheelhouse(requirements_file_path, key):
+    """
+    Build wheels for a remote requirements.pip into env.local_wheelhouse_dir/key
+
+    Runs env.wheel_build_command locally, and only when there is no
+    wheelhouse for this md5 yet.
+    """
+    wheelhouse = os.path.join(env.local_wheelhouse_dir, key)
+    if os.path.isdir(wheelhouse):
+        return wheelhouse
+
+    # build off to the side, parallel hosts may be building the same key
+    partial = '%s.partial-%d' % (wheelhouse, os.getpid())
+    local('rm -rf %s; mkdir -p %s' % (partial, partial))
+    get(requirements_file_path, partial + '/requirements.pip')
+    with settings(wheelhouse=partial, requirements=partial + '/requirements.pip'):
+        local(env.wheel_build_command % env)
+    try:
+        os.rename(partial, wheelhouse)
+    except OSError:
+        local('rm -rf %s' % partial)
+    return wheelhouse
 
 def setup_apache_wsgi(virtual_environment_name):
-    with settings(user='root'):
-        put(local_path="conf/wsgi/apache/app.example.com", remote_path="/etc/apache2/sites-available/%s" % virtual_environment_name)
     apache_site_file = '/etc/apache2/sites-available/%s' % virtual_environment_name
-    replace_in_file(apache_site_file, 'APP.EXAMPLE.COM', virtual_environment_name)
-    replace_in_file(apache_site_file, 'APPNAME', env.appname)
-    sudo("a2ensite %s" % virtual_environment_name)
-    sudo("service apache2 reload")
+    replacements = wsgi_daemon_sizing(virtual_environment_name)
+    replacements.update({
+        'APP.EXAMPLE.COM': virtual_environment_name,
+        'APPNAME': env.appname,
+    })
+    changed = upload_template("conf/wsgi/apache/app.example.com", apache_site_file, replacements)
+    enabled = virtual_environment_name not in facts()['apache_sites']
+    if enabled:
+        sudo("a2ensite %s" % virtual_environment_name)
+        facts()['apache_sites'].add(virtual_environment_name)
+    if changed or enabled:
+        notify_service('apache2')
+
+def wsgi_daemon_sizing(virtual_environment_name):
+    """
+    Helper function.
+    The WSGIDaemonProcess settings for one virtual environment
+
+    The processes of all virtual environments share wsgi_memory_share of
+    the RAM, at the measured RSS of a worker, and never exceed two per
+    core. Threads make up the wsgi_requests_per_core concurrency that
+    leaves. When memory is the limit, idle daemons are shut down sooner
+    to hand it back. Requests queued longer than wsgi_request_timeout
+    are turned away, if the installed mod_wsgi is 4.1 or later and knows
+    queue-timeout.
+    """
+    memory = facts()['memory_mb']
+    cores = facts()['cores']
+    rss = measure_wsgi_rss(virtual_environment_name) or int(env.wsgi_worker_rss_mb)
+
+    by_memory = int(memory * float(env.wsgi_memory_share) / rss)
+    total = max(len(env.virtual_environments), min(by_memory, cores * 2))
+    processes = max(1, total / len(env.virtual_environments))
+    concurrency = cores * int(env.wsgi_requests_per_core)
+    threads = min(25, max(1, -(-concurrency / total)))
+
+    return {
+        'WSGIGROUP': virtual_environment_name.replace('.', '-'),
+        'WSGIPROCESSES': processes,
+        'WSGITHREADS': threads,
+        'WSGIINACTIVITYTIMEOUT': by_memory < cores * 2 and 300 or 3600,
+        'WSGIQUEUETIMEOUT': facts()['mod_wsgi_version'] >= [4, 1]
+                            and 'queue-timeout=%s' % env.wsgi_request_timeout or '',
+    }
+
+def measure_wsgi_rss(virtual_environment_name):
+    """
+    Helper function.
+    The largest RSS in MB of the running daemons of a virtual environment
+
+    Returns None if none of them is running. mod_wsgi names them
+    (wsgi:<group>), cut short if the name is longer than the original
+    command line, so a prefix of it matches as well.
+    """
+    name = '(wsgi:%s)' % virtual_environment_name.replace('.', '-')
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        output = sudo("ps -eo rss=,args= | awk -v name='%s' "
+                      "'length($2) > 6 && index(name, $2) == 1 {print $1}'" % name)
+    sizes = [int(size) for size in output.split() if size.isdigit()]
+    if sizes:
+        return max(sizes) / 1024 + 1
+
+def plan_wsgi_capacity():
+    """
+    Show the mod_wsgi daemon sizing for each virtual environment
+    """
+    print '%d MB of RAM, %d cores' % (facts()['memory_mb'], facts()['cores'])
+    for name in env.virtual_environments:
+        sizing = wsgi_daemon_sizing(name)
+        print ('    %(WSGIGROUP)s: processes=%(WSGIPROCESSES)s threads=%(WSGITHREADS)s '
+               'inactivity-timeout=%(WSGIINACTIVITYTIMEOUT)s %(WSGIQUEUETIMEOUT)s' % sizing)
+
+def install_app_server(virtual_environment_name, env_path, restart=False):
+    """
+    Run a virtual environment under gunicorn or uwsgi, see env.app_server
+
+    The server is installed into the virtualenv and supervisor keeps it
+    running on a unix socket that nginx proxies to. Workers and threads
+    are sized like the mod_wsgi daemons, see wsgi_daemon_sizing(). It is
+    restarted when its settings or, with restart, the app config changed.
+    """
+    if not remote_exists('%s/current/bin/%s' % (env_path, env.app_server)):
+        sudo('source %s/current/bin/activate && pip install %s' % (env_path, env.app_server))
+    sudo('mkdir -p %s/run' % env_path)
+    set_user_and_group(env.server_groupname, env.server_groupname, env_path + '/run')
+
+    sizing = wsgi_daemon_sizing(virtual_environment_name)
+    command = env.app_server_commands[env.app_server] % {
+        'env_path': env_path,
+        'socket': app_server_socket(virtual_environment_name),
+        'processes': sizing['WSGIPROCESSES'],
+        'threads': sizing['WSGITHREADS'],
+        'worker': env.app_server_worker,
+        'timeout': env.wsgi_request_timeout,
+    }
+    changed = upload_template('conf/wsgi/supervisor/app.example.com',
+                              '/etc/supervisor/conf.d/%s.conf' % virtual_environment_name, {
+        'APPSERVERCOMMAND': command,
+        'APPSERVER': env.app_server,
+        'APP.EXAMPLE.COM': virtual_environment_name,
+        'APPNAME': env.appname,
+    })
+    if changed:
+        # starts new programs and restarts the ones whose config changed
+        sudo('supervisorctl reread && supervisorctl update')
+    elif restart:
+        sudo('supervisorctl restart %s' % virtual_environment_name)
+
+def app_server_socket(virtual_environment_name):
+    """
+    Helper function.
+    The unix socket the app server of a virtual environment listens on
+    """
+    return '%s/%s/run/%s.sock' % (env.webapps_location, virtual_environment_name, env.app_server)
+
+def app_server_upstream(site):
+    """
+    Helper function.
+    The address nginx proxies Django requests for a site to
+
+    Apache on port 9000, which picks the virtual host itself, or the app
+    server socket of the site's virtual environment.
+    """
+    if env.app_server == 'apache':
+        return 'localhost:9000'
+    return 'unix:%s fail_timeout=0' % app_server_socket(site_virtual_environment(site))
+
+def site_virtual_environment(site):
+    """
+    Helper function.
+    The virtual environment named after the site, the first one if none is
+    """
+    if site in env.virtual_environments:
+        return site
+    return env.virtual_environments[0]
+
+def collect_static(site, env_path):
+    """
+    Collect the static files of the virtualenv in env_path into the root
+    nginx serves the site from
+
+    collectstatic copies them to webroot_dir/<site> under static_url with
+    env.static_storage, which also writes fingerprinted copies nginx
+    serves with far-future expires (the app settings need the same
+    storage for templates to link them). Every compressible file then
+    gets .gz and, if brotli is installed, .br siblings for nginx to
+    serve as they are. Only new or changed files are compressed.
+    """
+    static_root = '%s/%s%s' % (env.webroot_dir, site, env.static_url.rstrip('/'))
+    sudo('mkdir -p %s/apache' % env_path)
+    upload_template('conf/wsgi/static_settings.py', env_path + '/apache/static_settings.py', {
+        'APPNAME': env.appname,
+        'STATICROOT': static_root,
+        'STATICURL': env.static_url,
+        'STATICSTORAGE': env.static_storage,
+    })
+    pythonpath = ':'.join([env_path + '/apache', env_path, env_path + '/' + env.appname])
+    with command_batch(use_sudo=True) as batch:
+        batch.append('mkdir -p %s' % static_root)
+        batch.append('source %s/bin/activate && PYTHONPATH=%s django-admin.py collectstatic '
+                     '--noinput --verbosity=0 --settings=static_settings' % (env_path, pythonpath))
+        batch.append(
+            'find %s -type f \\( %s \\) -print0 | xargs -0 -r -n 50 -P $(nproc) sh -c \''
+            'for f; do '
+            '[ "$f.gz" -nt "$f" ] || gzip -9 -c "$f" > "$f.gz"; '
+            'if command -v brotli > /dev/null; then [ "$f.br" -nt "$f" ] || brotli -f -q 11 -o "$f.br" "$f"; fi; '
+            'done\' sh' % (static_root, ' -o '.join(["-name '*.%s'" % ext for ext in env.static_compress])))
+    set_user_and_group(env.server_groupname, env.server_groupname, static_root)
 
 def clean_apache_wsgi():
     for name in virtual_environments:
@@ -1197,11 +3156,35 @@ def clean_apache_wsgi():
             sudo("rm %s" % name)
 
 def install_django_app_config_file(virtual_environment_name):
+    """
+    Upload the app config with the DATABASEHOST and DATABASEPORT
+    placeholders pointing at PgBouncer, or straight at PostgreSQL
+
+    Aborts if PgBouncer is on but the config lacks the placeholders, as
+    the apps would silently bypass it.
+    """
     config_file_name = env.appname + '.config'
     config_path = env.webapps_location+'/'+virtual_environment_name+'/'+config_file_name
-    with settings(user='root'):
-        put(local_path=env.local_config_file_path, remote_path=config_path)
-    set_user_and_group(env.server_groupname, env.server_groupname, config_path)
+    local_config_path = os.path.expanduser(env.local_config_file_path)
+    if env.pgbouncer:
+        config = open(local_config_path).read()
+        missing = [name for name in ('DATABASEHOST', 'DATABASEPORT') if name not in config]
+        if missing:
+            abort("%s has no %s placeholder, the apps would not connect through PgBouncer."
+                  % (env.local_config_file_path, ' or '.join(missing)))
+        host, port = '127.0.0.1', env.pgbouncer_port
+    else:
+        host, port = env.database_host, env.database_port
+    rendered_path = render_template(local_config_path, {
+        'DATABASEHOST': host,
+        'DATABASEPORT': port,
+    })
+    if sync_files([(rendered_path, config_path)]):
+        set_user_and_group(env.server_groupname, env.server_groupname, config_path)
+        if env.app_server == 'apache':
+            notify_service('apache2')
+        return True
+    return False
 
 def clean_django_app_config_file(virtual_environment_name):
     config_file_name = env.appname + '.config'
@@ -1213,6 +3196,8 @@ def make_keyczar_keys(virtual_environment_name,env_path):
     activate_path = env_path+'/bin/activate'
     keyczart_path = app_path+'/bin/keyczart'
     keys_path = app_path+'/keys'
+    if remote_exists(keys_path):
+        return
     sudo('source ' + activate_path + ' && ' + keyczart_path + ' ' + keys_path)
     
 def clean_keyczar_keys(virtual_environment_name):
@@ -1232,25 +3217,296 @@ def ve_run(cmd):
     Helper function.
     Runs a command using the virtualenv environment
     """
-    require('env_path')
-    return sshagent_run('source %s/bin/activate; %s' % (env.env_path, cmd))
+    require('current_path')
+    return sshagent_run('source %s/bin/activate; %s' % (env.current_path, cmd))
 
-def sshagent_run(cmd):
+@contextlib.contextmanager
+def command_batch(use_sudo=False):
+    """
+    Helper function.
+    Collects remote commands and runs them as one script over a single channel.
+
+    Usage::
+
+        with command_batch(use_sudo=True) as batch:
+            batch.append('mkdir -p /some/dir')
+            batch.append('chmod g+w /some/dir')
+
+    The commands run in order in the same shell, so ``cd`` and ``env``
+    changes carry over just like a chain of run() calls, and the first
+    failure stops the script. The exit status of every command that ran
+    is kept in env.batch_status as (command, status) pairs, and a failure
+    aborts naming the command, or only warns under warn_only.
+    """
+    commands = []
+    yield commands
+    run_batch(commands, use_sudo)
+
+def run_batch(commands, use_sudo=False):
+    """
+    Helper function.
+    Runs a list of commands as one remote script, see command_batch()
+    """
+    env.batch_status = []
+    if not commands:
+        return env.batch_status
+
+    marker = '::batch-status::'
+    script = []
+    for index, cmd in enumerate(commands):
+        script.append(cmd)
+        script.append('__status=$?; echo "%s %d $__status"; '
+            '[ $__status -eq 0 ] || exit $__status' % (marker, index))
+
+    with settings(hide('warnings'), warn_only=True):
+        if use_sudo:
+            result = sudo('\n'.join(script))
+        else:
+            result = run('\n'.join(script))
+
+    for line in result.splitlines():
+        if line.startswith(marker):
+            index, status = line[len(marker):].split()
+            env.batch_status.append((commands[int(index)], int(status)))
+
+    if result.failed:
+        if len(env.batch_status) < len(commands) and (
+            not env.batch_status or env.batch_status[-1][1] == 0):
+            # died before reporting, blame the next command in line
+            env.batch_status.append((commands[len(env.batch_status)],
+                result.return_code))
+        cmd, status = env.batch_status[-1]
+        msg = "batched command failed with exit code %d: %s" % (status, cmd)
+        if env.warn_only:
+            warn(msg)
+        else:
+            abort(msg)
+    return env.batch_status
+
+@contextlib.contextmanager
+def service_changes():
+    """
+    Helper function.
+    Coalesces the reloads and restarts asked for with notify_service().
+
+    Usage::
+
+        with service_changes():
+            a2enmod_rewrite()
+            a2enmod_proxy()
+
+    Every service that was notified inside the block gets exactly one
+    config test and one reload (or restart, if any task asked for one)
+    when the outermost block ends.
+    """
+    if env.service_changes is not None:
+        # already collecting, the outer block applies the changes
+        yield
+        return
+    env.service_changes = {}
+    try:
+        yield
+        changes = env.service_changes
+    finally:
+        env.service_changes = None
+    for service in sorted(changes):
+        apply_service_change(service, changes[service])
+
+def notify_service(service, action='reload'):
+    """
+    Helper function.
+    Marks a service as needing a reload or restart.
+
+    Inside service_changes() the action is deferred and merged with the
+    others, a restart winning over a reload. Outside it is applied at once.
+    """
+    if env.service_changes is None:
+        apply_service_change(service, action)
+    elif env.service_changes.get(service) != 'restart':
+        env.service_changes[service] = action
+
+def apply_service_change(service, action='reload'):
+    """
+    Helper function.
+    Reloads or restarts a service, after checking its configuration.
+
+    Aborts without touching the running service if the config test from
+    env.service_config_tests fails. A service that isn't running (say
+    nginx, which can't start while Apache still holds port 80 on a fresh
+    install) is started with a restart, since reload fails on it.
+    """
+    config_test = env.service_config_tests.get(service)
+    if config_test:
+        with settings(hide('warnings'), warn_only=True):
+            result = sudo(config_test)
+        if result.failed:
+            abort("%s configuration test failed, not running %s %s:\n%s" % (
+                service, service, action, result))
+    if action == 'reload':
+        with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+            if sudo('service %s status' % service).failed:
+                action = 'restart'
+    sudo('service %s %s' % (service, action))
+
+def fan_out(task, *args, **kwargs):
+    """
+    Helper function.
+    Runs a task against every host in env.hosts in parallel.
+
+    Each host gets its own process, at most env.parallel_pool_size (or
+    fab -z) of them at a time. Output is line buffered and prefixed with
+    the host string. Failures don't stop the other hosts; a summary is
+    printed at the end and the run aborts if any host failed.
+
+    Each child writes its result to a file of its own that is read after
+    all of them exited, so a big result (a profile tree, say) can't block
+    a child on a full pipe while the parent is waiting for it to exit.
+    """
+    hosts = list(env.hosts)
+    if not hosts:
+        abort("No hosts to run %s on, pick an environment first." % task.__name__)
+
+    pool_size = min(int(env.pool_size or env.parallel_pool_size), len(hosts))
+    jobs = job_queue.JobQueue(pool_size)
+    results_dir = tempfile.mkdtemp(prefix='fan_out-')
+
+    def result_path(host):
+        return os.path.join(results_dir, hashlib.md5(host).hexdigest())
+
+    def inner(host):
+        def put_result(error):
+            with open(result_path(host), 'w') as result:
+                json.dump([error, env.profile_roots], result)
+
+        # never share the parent's cached ssh connections with a child; the
+        # cache is keyed by normalized user@host:port and the child may
+        # also talk to other hosts, e.g. the load balancer
+        connections.clear()
+        env.sshagent_checked, env.sshagent_masters = [], []
+        # the child's timings go back to the parent with its result
+        env.profile_roots, env.profile_stack = [], []
+        with settings(host_string=host, linewise=True, parallel=True):
+            try:
+                task(*args, **kwargs)
+                put_result(None)
+            except SystemExit:
+                put_result('aborted')
+            except Exception, e:
+                put_result('%s: %s' % (e.__class__.__name__, e))
+                raise
+            finally:
+                # atexit handlers don't run in the child
+                sshagent_disconnect_all()
+
+    for host in hosts:
+        job = multiprocessing.Process(target=inner, args=(host,))
+        job.name = host
+        jobs.append(job)
+    jobs.close()
+    # the queue points host_string at each job in turn and leaves it there
+    host_string, host = env.host_string, env.host
+    try:
+        jobs.run()
+    finally:
+        env.host_string, env.host = host_string, host
+
+    failures = dict((host, 'no result') for host in hosts)
+    for host in hosts:
+        try:
+            with open(result_path(host)) as result:
+                error, timings = json.load(result)
+        except (IOError, ValueError):
+            continue
+        if env.profile_stack:
+            env.profile_stack[-1]['children'].extend(timings)
+        else:
+            env.profile_roots.extend(timings)
+        if error is None:
+            del failures[host]
+        else:
+            failures[host] = error
+    shutil.rmtree(results_dir, ignore_errors=True)
+
+    print
+    print '%s: %d host(s) ok, %d failed' % (task.__name__,
+        len(hosts) - len(failures), len(failures))
+    for host in hosts:
+        print '    [%s] %s' % (host, failures.get(host, 'ok'))
+    if failures:
+        abort("%s failed on %s" % (task.__name__, ', '.join(sorted(failures))))
+
+def sshagent_run(cmd, capture=False):
     """
     Helper function.
     Runs a command with SSH agent forwarding enabled.
 
     Note:: Fabric (and paramiko) can't forward your SSH agent.
-    This helper uses your system's ssh to do so.
+    This helper uses your system's ssh to do so, over one shared
+    ControlMaster connection per host, see sshagent_connect().
     """
     # Handle context manager modifications
     wrapped_cmd = _prefix_commands(_prefix_env_vars(cmd), 'remote')
+    command = "ssh %s %s" % (sshagent_connect(), shell_quote(wrapped_cmd))
+    if capture or not env.parallel:
+        return local(command, capture=capture)
+
+    # local() output has no host prefix, so in fan_out() children it is
+    # captured and written per host in one go, like run() output
+    warn_only = env.warn_only
+    lines = []
+    if output.running:
+        lines.append('sshagent_run: %s' % cmd)
+    with settings(hide('running'), warn_only=True):
+        result = local(command, capture=True)
+    for stream, text, shown in (('out', result, output.stdout), ('err', result.stderr, output.stderr)):
+        if shown:
+            lines.extend('%s: %s' % (stream, line) for line in text.splitlines())
+    if lines:
+        sys.stdout.write(''.join('[%s] %s\n' % (env.host_string, line) for line in lines))
+        sys.stdout.flush()
+    if result.failed and not warn_only:
+        abort("sshagent_run() encountered an error (return code %s) while executing '%s'" % (
+            result.return_code, cmd))
+    return result
+
+def sshagent_connect():
+    """
+    Helper function.
+    Returns the ssh arguments for reusing the master connection to the current host.
+
+    The master is health checked with ``ssh -O check`` the first time a host
+    is used and (re)started if it isn't answering. The masters this process
+    started are shut down with ``ssh -O exit`` when fab exits; one it found
+    running belongs to whoever started it.
+    """
     try:
         host, port = env.host_string.split(':')
-        return local(
-            "ssh -p %s -A %s@%s '%s'" % (port, env.user, host, wrapped_cmd)
-        )
+        args = '-p %s ' % port
     except ValueError:
-        return local(
-            "ssh -A %s@%s '%s'" % (env.user, env.host_string, wrapped_cmd)
-        )
+        host, args = env.host_string, ''
+    # a short hash keeps the socket path under the unix limit for long names
+    control_name = hashlib.md5('%s@%s' % (env.user, env.host_string)).hexdigest()[:12]
+    args += '-A -o ControlPath=%s/%s ' % (env.ssh_control_dir, control_name)
+    args += '-o ControlMaster=auto -o ControlPersist=%s %s@%s' % (
+        env.ssh_control_persist, env.user, host)
+
+    if args not in env.sshagent_checked:
+        if not os.path.isdir(env.ssh_control_dir):
+            os.makedirs(env.ssh_control_dir, 0700)
+        with settings(hide('running', 'warnings', 'stdout', 'stderr'), warn_only=True):
+            if local('ssh -O check %s' % args).failed:
+                local('ssh -f -N %s' % args)
+                if not env.sshagent_masters:
+                    atexit.register(sshagent_disconnect_all)
+                env.sshagent_masters.append(args)
+        env.sshagent_checked.append(args)
+    return args
+
+def sshagent_disconnect_all():
+    """
+    Helper function.
+    Closes every master connection started by sshagent_connect() in this process
+    """
+    with settings(hide('running', 'warnings', 'stdout', 'stderr'), warn_only=True):
+        while env.sshagent_masters:
+            local('ssh -O exit %s' % env.sshagent_masters.pop())
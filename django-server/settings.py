@@ -97,6 +97,10 @@ local_backup_dir  = os.path.abspath('./.bak')
 local_tar_dir     = os.path.abspath('./.tarballs')
 local_config_dir  = os.path.abspath('./conf')
 
+# sockets for the shared ssh -A connection used by sshagent_run
+ssh_control_dir     = os.path.expanduser('~/.ssh/django-server-fabfile')
+ssh_control_persist = '10m'
+
 remote_backup_dir = '/var/dumps/django-server-fabfile'
 remote_config_dir = '/var/local/django-server-fabfile'
 